@@ -9,4 +9,6 @@
 # preserved in all copies or distributions of this software's source.
 
 from . import meta, command_parse, cli, classes, syncfile, filescan
+from . import s3api, extsort, inventory, concurrency, dedup, transfer
+from . import sync, watch, audit, plan
 from .run import run
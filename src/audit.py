@@ -0,0 +1,227 @@
+# s3-bsync Copyright (c) 2022 Joshua Stockin
+# <https://joshstock.in>
+# <https://git.joshstock.in/s3-bsync>
+#
+# This software is licensed and distributed under the terms of the MIT License.
+# See the MIT License in the LICENSE file of this project's root folder.
+#
+# This comment block and its contents, including this disclaimer, MUST be
+# preserved in all copies or distributions of this software's source.
+
+import os
+import re
+import hashlib
+import logging
+import concurrent.futures
+
+from .classes import *
+from . import s3api
+from . import extsort
+from . import syncfile
+from . import filescan
+from . import transfer
+from . import concurrency
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["local_etag", "audit_dirmap", "audit"]
+
+
+AUDIT_RESULTS = {
+    "LOCAL_NOT_FOUND": 0b00000001,
+    "S3OBJ_NOT_FOUND": 0b00000010,
+    "NOT_TRACKED": 0b00000100,
+    "LOCAL_MODIFIED": 0b00001000,  # size or mtime changed since the last sync
+    "LOCAL_MISMATCH": 0b00010000,  # contents don't hash to the expected ETag
+    "S3OBJ_MISMATCH": 0b00100000,  # object ETag differs from the tracked ETag
+    "UNVERIFIABLE": 0b01000000,  # ETag isn't MD5 based (e.g. SSE-KMS)
+}
+
+# Disagreements with the tracked record other than local edits the next sync
+# would upload
+FAILURES = (
+    AUDIT_RESULTS["LOCAL_NOT_FOUND"]
+    | AUDIT_RESULTS["S3OBJ_NOT_FOUND"]
+    | AUDIT_RESULTS["LOCAL_MISMATCH"]
+    | AUDIT_RESULTS["S3OBJ_MISMATCH"]
+)
+
+AUDIT_WORKERS = min(8, os.cpu_count() or 1)
+MAX_PENDING = AUDIT_WORKERS * 4
+MAX_CANDIDATES = 8
+
+MD5_ETAG = re.compile(r"[0-9a-f]{32}(-[0-9]+)?")
+
+
+def part_sizes(size, count, recorded=0):
+    # The size recorded with the object's part digests or the size this
+    # program uploads with, then every whole number of MiB that splits the
+    # object into the same number of parts (as most clients use)
+    sizes = [recorded or transfer.part_size(size)]
+    mib = 1024 * 1024
+    low = -(-size // count)
+    high = size // (count - 1) if count > 1 else low
+    part = -(-low // mib) * mib
+    while part <= high and len(sizes) < MAX_CANDIDATES:
+        if -(-size // part) == count and part not in sizes:
+            sizes.append(part)
+        part += mib
+    return sizes
+
+
+def hash_part(part, rate=None):
+    md5 = hashlib.md5()
+    for offset in range(0, len(part), transfer.CHUNK_SIZE):
+        chunk = part[offset : offset + transfer.CHUNK_SIZE]
+        if rate is not None:
+            rate.consume(len(chunk))
+        md5.update(chunk)
+    return md5.digest()
+
+
+def parts_etag(parts, rate=None, single=False):
+    digests = [hash_part(part, rate) for part in parts]
+    if single and len(digests) == 1:
+        return digests[0].hex()
+    return transfer.multipart_etag(digests)
+
+
+# Computes the ETag the local file would have been uploaded with, guided by
+# the expected ETag's part count
+def local_etag(dirmap: sync_directory_map, key, expected, rate=None, part_size=0):
+    path = filescan.path_from_key(dirmap, key)
+    count = int(expected.split("-")[1]) if "-" in expected else None
+    with transfer.file_view(path) as (view, mapping, st):
+        if dirmap.gz_compress > 0:
+            parts = transfer.compressed_parts(
+                view, mapping, dirmap.gz_compress, transfer.part_size(len(view))
+            )
+            return parts_etag(parts, rate, single=count is None)
+        if count is None:
+            return hash_part(view, rate).hex()
+        etag = None
+        for size in part_sizes(len(view), count, part_size):
+            etag = parts_etag(transfer.plain_parts(view, mapping, size), rate)
+            if etag == expected:
+                break
+        return etag
+
+
+def check(
+    dirmap: sync_directory_map, key, local, remote, tracked, rate=None, part_size=0
+):
+    result = 0
+    if local is None:
+        result |= AUDIT_RESULTS["LOCAL_NOT_FOUND"]
+    if remote is None:
+        result |= AUDIT_RESULTS["S3OBJ_NOT_FOUND"]
+    if tracked is None:
+        result |= AUDIT_RESULTS["NOT_TRACKED"]
+        # Untracked keys only missing on one side are simply unsynced
+        if local is None or remote is None:
+            return result & AUDIT_RESULTS["NOT_TRACKED"]
+    elif remote is not None and remote[1] != tracked[1]:
+        result |= AUDIT_RESULTS["S3OBJ_MISMATCH"]
+
+    if local is None:
+        return result
+    if tracked is not None and (local[2], local[3]) != (tracked[2], tracked[3]):
+        return result | AUDIT_RESULTS["LOCAL_MODIFIED"]
+
+    expected = tracked[1] if tracked is not None else remote[1]
+    if not MD5_ETAG.fullmatch(expected):
+        return result | AUDIT_RESULTS["UNVERIFIABLE"]
+    if local_etag(dirmap, key, expected, rate, part_size) != expected:
+        result |= AUDIT_RESULTS["LOCAL_MISMATCH"]
+    return result
+
+
+def describe(result):
+    return ", ".join(name for name, flag in AUDIT_RESULTS.items() if result & flag)
+
+
+def audit_dirmap(
+    bucket: sync_managed_bucket, dirmap: sync_directory_map, rate=None, max_memory=None
+):
+    logger.debug(
+        f"Auditing directory map {syncfile.dirmap_stringify(dirmap.local_path, bucket.bucket_name, dirmap.s3_prefix)}"
+    )
+    local = filescan.local_scan(dirmap, max_memory)
+    remote = filescan.remote_scan(bucket.bucket_name, dirmap)
+    tracked = filescan.tracked_scan(bucket, dirmap)
+
+    results = {"CHECKED": 0, "FAILED": 0}
+    futures = {}
+
+    def collect(done):
+        for future in done:
+            key = futures.pop(future)
+            try:
+                result = future.result()
+            except OSError as e:
+                logger.error(f"Unable to read {key}: {e}")
+                results["FAILED"] += 1
+                continue
+            results["CHECKED"] += 1
+            for name, flag in AUDIT_RESULTS.items():
+                if result & flag:
+                    results[name] = results.get(name, 0) + 1
+            if result & FAILURES:
+                results["FAILED"] += 1
+            if result:
+                print(f"  s3://{bucket.bucket_name}/{key}: {describe(result)}")
+
+    with concurrent.futures.ThreadPoolExecutor(AUDIT_WORKERS) as executor:
+        for key, l, r, t in extsort.merge(local, remote, tracked):
+            fileobject = bucket.fileobjects.get(key)
+            future = executor.submit(
+                check,
+                dirmap,
+                key,
+                l,
+                r,
+                t,
+                rate,
+                fileobject.part_size if fileobject else 0,
+            )
+            futures[future] = key
+            if len(futures) >= MAX_PENDING:
+                done, _ = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                collect(done)
+        collect(concurrent.futures.as_completed(list(futures)))
+
+    return results
+
+
+# Compares local files, tracked records and objects without transferring or
+# recording anything. Exits nonzero if any copy is damaged or missing.
+def audit(state, selection=None, rate_limit=None, max_memory=None):
+    logger.debug("Running in AUDIT mode")
+    rate = concurrency.rate_limiter(rate_limit) if rate_limit else None
+    totals = {}
+    print(f"AUDIT mode")
+    for bucket in state.managed_buckets:
+        for dirmap in bucket.directory_maps:
+            if not syncfile.dirmap_selected(
+                selection, bucket.bucket_name, dirmap.s3_prefix
+            ):
+                continue
+            print(
+                f"Directory map {syncfile.dirmap_stringify(dirmap.local_path, bucket.bucket_name, dirmap.s3_prefix)}"
+            )
+            try:
+                results = audit_dirmap(bucket, dirmap, rate, max_memory)
+            except (s3api.ClientError, s3api.BotoCoreError) as e:
+                logger.error(f"Unable to audit s3://{bucket.bucket_name}: {e}")
+                totals["FAILED"] = totals.get("FAILED", 0) + 1
+                continue
+            for name, count in results.items():
+                totals[name] = totals.get(name, 0) + count
+
+    print(f"Audit results")
+    for name in ["CHECKED", *AUDIT_RESULTS, "FAILED"]:
+        print(f"  {name:<16}{totals.get(name, 0)}")
+    logger.debug("Finished audit. Exiting...")
+    exit(1 if totals.get("FAILED") else 0)
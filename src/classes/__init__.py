@@ -8,8 +8,16 @@
 # This comment block and its contents, including this disclaimer, MUST be
 # preserved in all copies or distributions of this software's source.
 
-__all__ = ["sync_managed_bucket", "sync_directory_map", "sync_fileobject"]
+__all__ = [
+    "sync_managed_bucket",
+    "sync_directory_map",
+    "sync_fileobject",
+    "sync_action",
+    "sync_upload",
+]
 
 from .sync_managed_bucket import *
 from .sync_directory_map import *
 from .sync_fileobject import *
+from .sync_action import *
+from .sync_upload import *
@@ -0,0 +1,23 @@
+# s3-bsync Copyright (c) 2022 Joshua Stockin
+# <https://joshstock.in>
+# <https://git.joshstock.in/s3-bsync>
+#
+# This software is licensed and distributed under the terms of the MIT License.
+# See the MIT License in the LICENSE file of this project's root folder.
+#
+# This comment block and its contents, including this disclaimer, MUST be
+# preserved in all copies or distributions of this software's source.
+
+from dataclasses import dataclass
+
+__all__ = ["sync_action"]
+
+
+@dataclass
+class sync_action:
+    action: int = 0
+    key: str = None
+    size: int = 0
+    etag: str = None
+    local_mtime: int = 0
+    remote_mtime: int = 0
@@ -8,7 +8,7 @@
 # This comment block and its contents, including this disclaimer, MUST be
 # preserved in all copies or distributions of this software's source.
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 __all__ = ["sync_fileobject"]
 
@@ -19,3 +19,5 @@ class sync_fileobject:
     modified: int = 0
     etag: str = None
     size: int = 0
+    part_size: int = 0
+    part_digests: list = field(default_factory=list)  # MD5 per part, for deltas
@@ -11,6 +11,7 @@
 
 from .sync_directory_map import sync_directory_map
 from .sync_fileobject import sync_fileobject
+from .sync_upload import sync_upload
 
 __all__ = ["sync_managed_bucket"]
 
@@ -19,7 +20,10 @@ class sync_managed_bucket:
     def __init__(self, bucket_name):
         self.bucket_name = bucket_name
         self.directory_maps = []
-        self.fileobjects = []
+        self.fileobjects = {}
+        self.uploads = {}
+        # Set by the state file holding this bucket; persists upload sessions
+        self.save_uploads = None
 
     def create_dirmap(
         self,
@@ -39,10 +43,35 @@ class sync_managed_bucket:
         dirmap.gpg_email = gpg_email
         self.directory_maps.append(dirmap)
 
-    def create_fileobject(self, key, modified, etag, size):
+    def create_fileobject(
+        self, key, modified, etag, size, part_size=0, part_digests=None
+    ):
         fileobject = sync_fileobject()
-        fileobject.key = None
-        fileobject.modified = 0
-        fileobject.etag = None
-        fileobject.size = 0
-        self.fileobjects.append(fileobject)
+        fileobject.key = key
+        fileobject.modified = modified
+        fileobject.etag = etag
+        fileobject.size = size
+        fileobject.part_size = part_size
+        fileobject.part_digests = part_digests or []
+        self.fileobjects[key] = fileobject
+        return fileobject
+
+    def remove_fileobject(self, key):
+        return self.fileobjects.pop(key, None)
+
+    def create_upload(
+        self, key, upload_id, size, modified, inode, part_size, compressed=False
+    ):
+        upload = sync_upload()
+        upload.key = key
+        upload.upload_id = upload_id
+        upload.size = size
+        upload.modified = modified
+        upload.inode = inode
+        upload.part_size = part_size
+        upload.compressed = compressed
+        self.uploads[key] = upload
+        return upload
+
+    def remove_upload(self, key):
+        return self.uploads.pop(key, None)
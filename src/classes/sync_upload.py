@@ -0,0 +1,25 @@
+# s3-bsync Copyright (c) 2021 Joshua Stockin
+# <https://joshstock.in>
+# <https://git.joshstock.in/s3-bsync>
+#
+# This software is licensed and distributed under the terms of the MIT License.
+# See the MIT License in the LICENSE file of this project's root folder.
+#
+# This comment block and its contents, including this disclaimer, MUST be
+# preserved in all copies or distributions of this software's source.
+
+from dataclasses import dataclass, field
+
+__all__ = ["sync_upload"]
+
+
+@dataclass
+class sync_upload:
+    key: str = None
+    upload_id: str = None
+    size: int = 0
+    modified: int = 0
+    inode: int = 0
+    part_size: int = 0
+    compressed: bool = False
+    parts: dict = field(default_factory=dict)  # part number -> ETag
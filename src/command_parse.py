@@ -14,6 +14,7 @@ import argparse
 import logging
 
 from .meta import package_info
+from . import extsort
 
 logger = logging.getLogger(__name__)
 
@@ -72,6 +73,71 @@ def command_parse(args: list[str]):
         default=False,
         help="Run program logic without making changes. Useful when paired with debug mode to see what changes would be made.",
     )
+    group1.add_argument(
+        "--stats",
+        action="store_true",
+        default=False,
+        help="Print transfer statistics, including the adaptive concurrency window and throughput per bucket and prefix, after syncing.",
+    )
+    group1.add_argument(
+        "--watch",
+        action="store_true",
+        default=False,
+        help="Run as a daemon that watches mapped directories with inotify and continuously syncs changed files. Linux only.",
+    )
+    group1.add_argument(
+        "--audit",
+        action="store_true",
+        default=False,
+        help="Hash local files and compare them, the tracking file and object ETags in S3, report "
+        "disagreements and exit without transferring anything. Exits nonzero on mismatches.",
+    )
+    group1.add_argument(
+        "--rate-limit",
+        metavar=("SIZE"),
+        default=argparse.SUPPRESS,
+        help="Cap the rate local files are read at in audit mode, per second (e.g. `50M`).",
+    )
+
+    group1.add_argument(
+        "--plan-out",
+        metavar=("FILE"),
+        default=argparse.SUPPRESS,
+        help="Compute the sync plan and write it to FILE with its totals and estimated duration, without making changes.",
+    )
+    group1.add_argument(
+        "--apply",
+        metavar=("FILE"),
+        default=argparse.SUPPRESS,
+        help="Execute a plan written by --plan-out without rescanning. Keys changed since the plan was made are skipped.",
+    )
+
+    group1.add_argument(
+        "--inventory",
+        action="append",
+        metavar=("MANIFEST"),
+        default=argparse.SUPPRESS,
+        help="S3 Inventory manifest.json (local path or `s3://` URL) to read remote "
+        "object listings from instead of listing the whole bucket. Keys sorting after "
+        "the inventory's last key are still listed. Can be used once per bucket.",
+    )
+
+    group1.add_argument(
+        "--only",
+        action="append",
+        metavar=("S3_PATH"),
+        default=argparse.SUPPRESS,
+        help="Only sync directory maps under `s3://bucket-name[/prefix]`. Can be used multiple times. "
+        "With a sharded tracking file, only the shards holding those directory maps are loaded and locked.",
+    )
+    group1.add_argument(
+        "--max-memory",
+        metavar=("SIZE"),
+        default=argparse.SUPPRESS,
+        help="Cap memory used by the sync diff's scans (e.g. `512M`, `2G`). Scans larger "
+        "than the cap are sorted in runs spilled to temporary files and merged from "
+        "disk. Tracked objects loaded from the state file are not counted.",
+    )
 
     group2 = parser.add_argument_group(
         "tracking file management", "Configuring the tracking file."
@@ -81,7 +147,15 @@ def command_parse(args: list[str]):
         "--file",
         metavar=("SYNCFILE"),
         default="~/.state.s3sync",
-        help="The s3sync state file used to store tracking and state information. It should resolve to an absolute path.",
+        help="The s3sync state file used to store tracking and state information. It should resolve to an absolute path. "
+        "If it resolves to a directory, the state is sharded into one file per bucket or directory map inside it.",
+    )
+    group2.add_argument(
+        "--shard",
+        choices=["bucket", "dirmap"],
+        default=argparse.SUPPRESS,
+        help="Create the tracking file as a directory of state files sharded per bucket or per directory map, "
+        "each locked separately so runs syncing different shards can proceed in parallel. Requires init mode.",
     )
     group2.add_argument(
         "--dump",
@@ -153,8 +227,7 @@ def sanitize_arguments(args: argparse.Namespace):
         logger.error("Inputted tracking file path is not an absolute path")
         exit(1)
     if os.path.isdir(args.file):
-        logger.error("Inputted tracking file path resolves to an existing directory")
-        exit(1)
+        logger.debug("Tracking file path resolves to a sharded state directory")
     logger.debug(f'Tracking file set to "{args.file}"')
     settings.syncfile = args.file
 
@@ -175,9 +248,24 @@ def sanitize_arguments(args: argparse.Namespace):
         else:
             logger.error("PURGE mode requires INIT mode")
             exit(1)
+    if hasattr(args, "shard"):
+        if not args.init:
+            logger.error("--shard requires INIT mode")
+            exit(1)
+        if os.path.isfile(args.file):
+            logger.error("--shard requires the tracking file path to be a directory")
+            exit(1)
+        logger.debug(f"Sharding state by {args.shard}")
+        settings.shard_mode = args.shard
     if args.dump:
         logger.debug("DUMP mode set")
         settings.mode = ["DUMP"]
+    if args.audit:
+        if hasattr(settings, "mode"):
+            logger.error("AUDIT mode can't be combined with INIT or DUMP mode")
+            exit(1)
+        logger.debug("AUDIT mode set")
+        settings.mode = ["AUDIT"]
 
     if not hasattr(settings, "mode"):
         logger.debug("No mode set. Enabling SYNC mode implicitly")
@@ -185,6 +273,84 @@ def sanitize_arguments(args: argparse.Namespace):
         if args.dryrun:
             logger.debug("DRYRUN flag enabled")
             settings.mode.append("DRYRUN")
+        if args.stats:
+            logger.debug("STATS flag enabled")
+            settings.stats = True
+        if args.watch:
+            logger.debug("WATCH mode set")
+            settings.mode.append("WATCH")
+    elif args.watch:
+        logger.error("WATCH mode requires SYNC mode")
+        exit(1)
+
+    if hasattr(args, "plan_out") or hasattr(args, "apply"):
+        if "SYNC" not in settings.mode or "WATCH" in settings.mode:
+            logger.error("--plan-out and --apply require SYNC mode without WATCH")
+            exit(1)
+        if hasattr(args, "plan_out") and hasattr(args, "apply"):
+            logger.error("--plan-out and --apply can't be used together")
+            exit(1)
+    if hasattr(args, "plan_out"):
+        plan_out = os.path.expanduser(args.plan_out)
+        if os.path.isdir(plan_out):
+            logger.error(f'Plan path "{plan_out}" is a directory')
+            exit(1)
+        logger.debug(f'Writing plan to "{plan_out}"')
+        settings.plan_out = plan_out
+    if hasattr(args, "apply"):
+        plan = os.path.expanduser(args.apply)
+        if not os.path.isfile(plan):
+            logger.error(f'Plan file "{plan}" does not exist')
+            exit(1)
+        logger.debug(f'Applying plan "{plan}"')
+        settings.plan = plan
+
+    if hasattr(args, "rate_limit"):
+        if "AUDIT" not in settings.mode:
+            logger.error("--rate-limit requires AUDIT mode")
+            exit(1)
+        settings.rate_limit = extsort.parse_size(args.rate_limit)
+        if not settings.rate_limit:
+            logger.error(f'Invalid rate "{args.rate_limit}"')
+            exit(1)
+        logger.debug(f"Audit reads capped at {settings.rate_limit} bytes per second")
+
+    if hasattr(args, "inventory"):
+        if "SYNC" not in settings.mode or hasattr(args, "apply"):
+            logger.error("--inventory requires SYNC mode without --apply")
+            exit(1)
+        settings.inventories = []
+        for manifest in args.inventory:
+            if not manifest.startswith("s3://") and not os.path.isfile(manifest):
+                logger.error(f'Inventory manifest "{manifest}" does not exist')
+                exit(1)
+            settings.inventories.append(manifest)
+
+    if hasattr(args, "only"):
+        if "SYNC" not in settings.mode and "AUDIT" not in settings.mode:
+            logger.error("--only requires SYNC or AUDIT mode")
+            exit(1)
+        settings.selection = []
+        for s3_path in args.only:
+            s3match = re.match(
+                r"^s3:\/\/([a-z0-9][a-z0-9-]{1,61}[a-z0-9])(?:\/(.*))?$", s3_path
+            )
+            if not s3match:
+                logger.error(f'User supplied invalid S3 path ("{s3_path}")')
+                exit(1)
+            settings.selection.append(
+                (s3match.group(1), (s3match.group(2) or "").rstrip("/"))
+            )
+
+    if hasattr(args, "max_memory"):
+        if "SYNC" not in settings.mode and "AUDIT" not in settings.mode:
+            logger.error("--max-memory requires SYNC or AUDIT mode")
+            exit(1)
+        settings.max_memory = extsort.parse_size(args.max_memory)
+        if not settings.max_memory:
+            logger.error(f'Invalid memory size "{args.max_memory}"')
+            exit(1)
+        logger.debug(f"Memory capped at {settings.max_memory} bytes")
 
     if hasattr(args, "dir"):
         if not args.init:
@@ -0,0 +1,209 @@
+# s3-bsync Copyright (c) 2022 Joshua Stockin
+# <https://joshstock.in>
+# <https://git.joshstock.in/s3-bsync>
+#
+# This software is licensed and distributed under the terms of the MIT License.
+# See the MIT License in the LICENSE file of this project's root folder.
+#
+# This comment block and its contents, including this disclaimer, MUST be
+# preserved in all copies or distributions of this software's source.
+
+import time
+import random
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["aimd_window", "adaptive_limiter", "rate_limiter", "limiter", "report"]
+
+
+MIN_WINDOW = 1
+MAX_WINDOW = 64
+INITIAL_WINDOW = 4
+DECREASE_FACTOR = 0.5
+SAMPLE_INTERVAL = 1.0  # seconds of completions compared between increases
+
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 0.2
+BACKOFF_CAP = 30.0
+
+
+def backoff(attempt):
+    # "Full jitter": uniformly random up to the exponential ceiling
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+
+
+class aimd_window:
+    def __init__(self, name, initial=INITIAL_WINDOW):
+        self.name = name
+        self.window = float(initial)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.sample_start = time.monotonic()
+        self.sample_bytes = 0
+        self.sample_requests = 0
+        self.byte_rate = 0.0
+        self.request_rate = 0.0
+        self.total_bytes = 0
+        self.total_requests = 0
+        self.throttles = 0
+        self.last_decrease = float("-inf")
+        self.saturated = False
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.window):
+                self.condition.wait()
+            self.in_flight += 1
+            if self.in_flight >= int(self.window):
+                self.saturated = True
+
+    def release(self, nbytes=0, throttled=False, completed=True):
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.throttles += 1
+                # Requests in flight together tend to be throttled together;
+                # decrease once per interval rather than once per response
+                if now - self.last_decrease < SAMPLE_INTERVAL:
+                    self.condition.notify_all()
+                    return
+                self.last_decrease = now
+                self.window = max(MIN_WINDOW, self.window * DECREASE_FACTOR)
+                # Measure the shrunken window afresh rather than against the
+                # throughput it had before being throttled
+                self.byte_rate = 0.0
+                self.request_rate = 0.0
+                self.reset_sample(now)
+                logger.debug(f"Throttled on {self.name}; window {self.window:.1f}")
+            elif completed:
+                self.sample_bytes += nbytes
+                self.sample_requests += 1
+                self.total_bytes += nbytes
+                self.total_requests += 1
+                elapsed = now - self.sample_start
+                if elapsed >= SAMPLE_INTERVAL:
+                    self.sample(elapsed, now)
+            self.condition.notify_all()
+
+    def sample(self, elapsed, now):
+        byte_rate = self.sample_bytes / elapsed
+        request_rate = self.sample_requests / elapsed
+        rising = byte_rate > self.byte_rate or request_rate > self.request_rate
+        # Growing a window that was never filled tells us nothing
+        if rising and self.saturated and self.window < MAX_WINDOW:
+            self.window = min(MAX_WINDOW, self.window + 1)
+            logger.debug(f"Window on {self.name} increased to {self.window:.0f}")
+        self.byte_rate = byte_rate
+        self.request_rate = request_rate
+        self.reset_sample(now)
+
+    def reset_sample(self, now):
+        self.sample_start = now
+        self.sample_bytes = 0
+        self.sample_requests = 0
+        self.saturated = self.in_flight >= int(self.window)
+
+
+class adaptive_limiter:
+    def __init__(self):
+        self.windows = {}
+        self.lock = threading.Lock()
+        self.retries = 0
+
+    def window(self, name):
+        with self.lock:
+            if name not in self.windows:
+                self.windows[name] = aimd_window(name)
+            return self.windows[name]
+
+    # Runs func holding a slot in the prefix window, then the bucket window.
+    # Throttling and server errors shrink both windows and are retried with
+    # jittered exponential backoff; other errors are raised immediately.
+    def call(self, bucket_name, prefix, nbytes, retriable, func, *args):
+        windows = [self.window(f"{bucket_name}/{prefix}"), self.window(bucket_name)]
+        attempt = 0
+        while True:
+            for window in windows:
+                window.acquire()
+            completed = False
+            throttled = False
+            try:
+                result = func(*args)
+                completed = True
+                return result
+            except Exception as e:
+                if not retriable(e):
+                    raise
+                throttled = True
+                attempt += 1
+                if attempt >= MAX_ATTEMPTS:
+                    raise
+                logger.debug(f"Retrying {prefix} after {e} (attempt {attempt})")
+            finally:
+                for window in reversed(windows):
+                    window.release(nbytes, throttled, completed)
+            with self.lock:
+                self.retries += 1
+            time.sleep(backoff(attempt))
+
+    def stats(self):
+        with self.lock:
+            windows = sorted(self.windows.values(), key=lambda w: w.name)
+        return [
+            {
+                "name": w.name,
+                "window": int(w.window),
+                "in_flight": w.in_flight,
+                "byte_rate": w.byte_rate,
+                "request_rate": w.request_rate,
+                "total_bytes": w.total_bytes,
+                "total_requests": w.total_requests,
+                "throttles": w.throttles,
+            }
+            for w in windows
+        ]
+
+
+# Paces callers to a fixed number of units (e.g. bytes) per second across all
+# threads by handing out consecutive time slots
+class rate_limiter:
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def consume(self, n):
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next_time, now)
+            self.next_time = start + n / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+limiter = adaptive_limiter()
+
+
+def format_bytes(n):
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if n < 1024 or unit == "TiB":
+            return f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def report():
+    lines = [f"  Retries: {limiter.retries}"]
+    for w in limiter.stats():
+        lines.append(f'  Window "{w["name"]}"')
+        lines.append(f'    window     {w["window"]} ({w["in_flight"]} in flight)')
+        lines.append(
+            f'    throughput {format_bytes(w["byte_rate"])}/s, {w["request_rate"]:.1f} req/s'
+        )
+        lines.append(
+            f'    total      {format_bytes(w["total_bytes"])}, {w["total_requests"]} requests'
+        )
+        lines.append(f'    throttled  {w["throttles"]}')
+    return lines
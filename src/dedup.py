@@ -0,0 +1,74 @@
+# s3-bsync Copyright (c) 2022 Joshua Stockin
+# <https://joshstock.in>
+# <https://git.joshstock.in/s3-bsync>
+#
+# This software is licensed and distributed under the terms of the MIT License.
+# See the MIT License in the LICENSE file of this project's root folder.
+#
+# This comment block and its contents, including this disclaimer, MUST be
+# preserved in all copies or distributions of this software's source.
+
+import logging
+import threading
+
+from .classes import *
+from . import filescan
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["content_index", "index"]
+
+
+# Copying a small object costs about as much as uploading it, so small objects
+# are left out of the index
+DEDUP_MIN_SIZE = 1024 * 1024
+
+
+# Maps (size, ETag) to an object known to hold that content, across every
+# tracked bucket. Entries are (bucket name, key, part size, part digests).
+# Objects in compressed directory maps are left out, since their ETags are
+# those of the compressed data.
+class content_index:
+    def __init__(self):
+        self.entries = {}
+        self.sizes = set()
+        self.lock = threading.Lock()
+
+    def build(self, buckets):
+        for bucket in buckets:
+            dirmaps = [d for d in bucket.directory_maps if d.gz_compress == 0]
+            for key, fileobject in bucket.fileobjects.items():
+                if any(filescan.key_in_dirmap(dirmap, key) for dirmap in dirmaps):
+                    self.add(
+                        bucket.bucket_name,
+                        key,
+                        fileobject.etag,
+                        fileobject.size,
+                        fileobject.part_size,
+                        fileobject.part_digests,
+                    )
+        logger.debug(f"Content index holds {len(self.entries)} objects")
+
+    def add(self, bucket_name, key, etag, size, part_size=0, part_digests=None):
+        if size < DEDUP_MIN_SIZE or not etag:
+            return
+        with self.lock:
+            self.entries[(size, etag)] = (bucket_name, key, part_size, part_digests)
+            self.sizes.add(size)
+
+    def discard(self, size, etag):
+        with self.lock:
+            self.entries.pop((size, etag), None)
+
+    # Whether hashing a file of this size could find a match
+    def has_size(self, size):
+        return size in self.sizes
+
+    def lookup(self, size, etag, bucket_name, key):
+        entry = self.entries.get((size, etag))
+        if entry is None or (entry[0], entry[1]) == (bucket_name, key):
+            return None
+        return entry
+
+
+index = content_index()
@@ -0,0 +1,134 @@
+# s3-bsync Copyright (c) 2022 Joshua Stockin
+# <https://joshstock.in>
+# <https://git.joshstock.in/s3-bsync>
+#
+# This software is licensed and distributed under the terms of the MIT License.
+# See the MIT License in the LICENSE file of this project's root folder.
+#
+# This comment block and its contents, including this disclaimer, MUST be
+# preserved in all copies or distributions of this software's source.
+
+import re
+import heapq
+import struct
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["external_sort", "sort_entries", "merge", "parse_size"]
+
+
+# Spilled entry: key length, etag length (0xFF for no etag), size, mtime, key,
+# etag
+ENTRY_HEADER = struct.Struct("<HBQQ")
+NO_ETAG = 0xFF
+
+# Rough in-memory cost of one (key, etag, size, mtime) tuple besides its strings
+ENTRY_OVERHEAD = 240
+
+RUN_BUFFER_SIZE = 64 * 1024
+
+SIZE_SUFFIXES = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(value):
+    match = re.fullmatch(r"(\d+)\s*([KMGT]?)i?B?", value.strip().upper())
+    if not match:
+        return None
+    return int(match.group(1)) * SIZE_SUFFIXES[match.group(2)]
+
+
+def write_entry(f, entry):
+    key, etag, size, mtime = entry
+    key = key.encode()
+    if etag is None:
+        f.write(ENTRY_HEADER.pack(len(key), NO_ETAG, size, mtime) + key)
+    else:
+        etag = etag.encode()
+        f.write(ENTRY_HEADER.pack(len(key), len(etag), size, mtime) + key + etag)
+
+
+def read_entries(f):
+    while header := f.read(ENTRY_HEADER.size):
+        key_length, etag_length, size, mtime = ENTRY_HEADER.unpack(header)
+        key = f.read(key_length).decode()
+        etag = None
+        if etag_length != NO_ETAG:
+            etag = f.read(etag_length).decode()
+        yield (key, etag, size, mtime)
+    f.close()
+
+
+class external_sort:
+    def __init__(self, max_memory):
+        self.max_memory = max_memory
+        self.entries = []
+        self.memory = 0
+        self.runs = []
+        self.max_key = None
+
+    def add(self, entry):
+        self.entries.append(entry)
+        self.memory += ENTRY_OVERHEAD + len(entry[0]) + len(entry[1] or "")
+        if self.max_key is None or entry[0] > self.max_key:
+            self.max_key = entry[0]
+        if self.memory >= self.max_memory:
+            self.spill()
+
+    def extend(self, entries):
+        for entry in entries:
+            self.add(entry)
+        return self
+
+    def spill(self):
+        self.entries.sort()
+        f = tempfile.TemporaryFile(buffering=RUN_BUFFER_SIZE)
+        for entry in self.entries:
+            write_entry(f, entry)
+        f.seek(0)
+        self.runs.append(f)
+        logger.debug(f"Spilled run of {len(self.entries)} entries to disk")
+        self.entries = []
+        self.memory = 0
+
+    def __iter__(self):
+        if not self.runs:
+            self.entries.sort()
+            entries = self.entries
+            self.entries = []
+            return iter(entries)
+        if self.entries:
+            self.spill()
+        logger.debug(f"Merging {len(self.runs)} sorted runs")
+        runs = [read_entries(f) for f in self.runs]
+        self.runs = []
+        return heapq.merge(*runs)
+
+
+def sort_entries(entries, max_memory=None):
+    if max_memory is None:
+        return sorted(entries)
+    return external_sort(max_memory).extend(entries)
+
+
+def tag(stream, index):
+    for entry in stream:
+        yield entry[0], index, entry
+
+
+# Merge several streams sorted by key, yielding each key once along with the
+# entry each stream had for it (or None)
+def merge(*streams):
+    current_key = None
+    slots = [None] * len(streams)
+    tagged = [tag(stream, index) for index, stream in enumerate(streams)]
+    for key, index, entry in heapq.merge(*tagged):
+        if key != current_key:
+            if current_key is not None:
+                yield current_key, *slots
+            current_key = key
+            slots = [None] * len(streams)
+        slots[index] = entry
+    if current_key is not None:
+        yield current_key, *slots
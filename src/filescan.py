@@ -9,16 +9,26 @@
 # preserved in all copies or distributions of this software's source.
 
 import os
-import time
+import stat
 import logging
-import glob
 
 from .classes import *
-from . import syncfile
+from . import s3api
+from . import extsort
 
 logger = logging.getLogger(__name__)
 
-__all__ = ["bucket_scan"]
+__all__ = [
+    "key_from_path",
+    "path_from_key",
+    "key_in_dirmap",
+    "key_prefix",
+    "local_entry",
+    "local_scan",
+    "remote_scan",
+    "refresh_stale",
+    "tracked_scan",
+]
 
 
 COMPARE_RESULTS = {
@@ -30,8 +40,123 @@ COMPARE_RESULTS = {
     "S3OBJ_LARGER":    0b00100000,
 }
 
-def by_bucket(bucket: sync_managed_bucket):
-    for dirmap in bucket.directory_maps:
-        for root, dirs, files in os.walk(dirmap.local_path):
-            for file in files:
-                logger.debug(f"{os.path.join(root, file)}")
+
+TEMP_SUFFIX = ".s3bsync-tmp"
+
+
+# Scan entries are (key, etag, size, mtime) tuples sorted by key. Local entries
+# have no etag; tracked entries record the local mtime seen at the last sync.
+
+
+def key_from_path(dirmap: sync_directory_map, path):
+    relpath = os.path.relpath(path, dirmap.local_path)
+    return f"{dirmap.s3_prefix}/{relpath.replace(os.sep, '/')}"
+
+
+def path_from_key(dirmap: sync_directory_map, key):
+    relpath = key[len(dirmap.s3_prefix) + 1 :]
+    return os.path.join(dirmap.local_path, *relpath.split("/"))
+
+
+def key_in_dirmap(dirmap: sync_directory_map, key):
+    if not key.startswith(dirmap.s3_prefix + "/"):
+        return False
+    relpath = key[len(dirmap.s3_prefix) + 1 :]
+    if not relpath or relpath.endswith("/") or relpath.endswith(TEMP_SUFFIX):
+        return False
+    if not dirmap.recursive and "/" in relpath:
+        return False
+    return True
+
+
+# The directory map prefix plus the key's first path component, which is the
+# granularity transfer concurrency is adapted at
+def key_prefix(dirmap: sync_directory_map, key):
+    relpath = key[len(dirmap.s3_prefix) + 1 :]
+    if "/" not in relpath:
+        return dirmap.s3_prefix
+    return f"{dirmap.s3_prefix}/{relpath.split('/', 1)[0]}"
+
+
+def local_entry(dirmap: sync_directory_map, key):
+    try:
+        st = os.stat(path_from_key(dirmap, key))
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return (key, None, st.st_size, st.st_mtime_ns // 1000000)
+
+
+def local_scan(dirmap: sync_directory_map, max_memory=None):
+    logger.debug(f"Scanning local directory {dirmap.local_path}")
+    return extsort.sort_entries(local_walk(dirmap), max_memory)
+
+
+def local_walk(dirmap: sync_directory_map):
+    for root, dirs, files in os.walk(dirmap.local_path):
+        if not dirmap.recursive:
+            dirs.clear()
+        for file in files:
+            key = key_from_path(dirmap, os.path.join(root, file))
+            if not key_in_dirmap(dirmap, key):
+                continue
+            entry = local_entry(dirmap, key)
+            if entry:
+                yield entry
+
+
+def remote_scan(bucket_name, dirmap: sync_directory_map, inventory=None):
+    prefix = dirmap.s3_prefix + "/"
+    if inventory is None:
+        logger.debug(f"Listing s3://{bucket_name}/{prefix}")
+        return (
+            entry
+            for entry in s3api.list_objects(bucket_name, prefix)
+            if key_in_dirmap(dirmap, entry[0])
+        )
+
+    logger.debug(f"Reading s3://{bucket_name}/{prefix} from inventory")
+    entries = (
+        entry for entry in inventory.entries(prefix) if key_in_dirmap(dirmap, entry[0])
+    )
+    return list_after(bucket_name, dirmap, entries)
+
+
+# Only keys sorting after the inventory's last key are listed; objects changed
+# elsewhere in the prefix are picked up by the next inventory
+def list_after(bucket_name, dirmap: sync_directory_map, entries):
+    start_after = ""
+    for entry in entries:
+        start_after = entry[0]
+        yield entry
+    logger.debug(f"Listing s3://{bucket_name}/{dirmap.s3_prefix}/ after {start_after}")
+    for entry in s3api.list_objects(bucket_name, dirmap.s3_prefix + "/", start_after):
+        if key_in_dirmap(dirmap, entry[0]):
+            yield entry
+
+
+# Inventory entries predate anything written since the report was generated;
+# keys sorting after its last key are listed live. Up to that key, a tracked
+# record the report disagrees with, or an untracked local file the report
+# doesn't have, is checked with HEAD so it isn't mistaken for a remote deletion
+# or modification, or uploaded over an object created since.
+def refresh_stale(bucket_name, last_key, key, local, remote, tracked):
+    if last_key is None or key > last_key:
+        return remote
+    if tracked is not None:
+        stale = remote is None or remote[1] != tracked[1]
+    else:
+        stale = remote is None and local is not None
+    if stale:
+        return s3api.head_object(bucket_name, key)
+    return remote
+
+
+# Tracked records are already in memory with the rest of the state. Only
+# references to their keys are sorted, and entries are built as they're read.
+def tracked_scan(bucket: sync_managed_bucket, dirmap: sync_directory_map):
+    keys = sorted(key for key in bucket.fileobjects if key_in_dirmap(dirmap, key))
+    for key in keys:
+        o = bucket.fileobjects[key]
+        yield (o.key, o.etag, o.size, o.modified)
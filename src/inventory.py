@@ -0,0 +1,193 @@
+# s3-bsync Copyright (c) 2022 Joshua Stockin
+# <https://joshstock.in>
+# <https://git.joshstock.in/s3-bsync>
+#
+# This software is licensed and distributed under the terms of the MIT License.
+# See the MIT License in the LICENSE file of this project's root folder.
+#
+# This comment block and its contents, including this disclaimer, MUST be
+# preserved in all copies or distributions of this software's source.
+
+import os
+import io
+import re
+import csv
+import gzip
+import json
+import shutil
+import logging
+import datetime
+import tempfile
+import urllib.parse
+
+from . import s3api
+from . import extsort
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["inventory"]
+
+
+# Column names used by ORC and Parquet inventories for each CSV schema field
+COLUMNS = {
+    "Key": "key",
+    "Size": "size",
+    "LastModifiedDate": "last_modified_date",
+    "ETag": "e_tag",
+    "IsLatest": "is_latest",
+    "IsDeleteMarker": "is_delete_marker",
+}
+
+# Optional inventory fields the sync can't do without
+REQUIRED_FIELDS = ["Key", "Size", "LastModifiedDate", "ETag"]
+
+
+def parse_timestamp(value):
+    if isinstance(value, datetime.datetime):
+        timestamp = value
+    else:
+        timestamp = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return s3api.to_millis(timestamp)
+
+
+class inventory:
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.s3match = re.match(r"^s3:\/\/([^\/]+)\/(.*)$", manifest_path)
+
+        with self.open(manifest_path) as f:
+            manifest = json.load(f)
+
+        self.source_bucket = manifest["sourceBucket"]
+        self.destination_bucket = manifest["destinationBucket"].split(":")[-1]
+        self.creation_time = int(manifest["creationTimestamp"])
+        self.file_format = manifest["fileFormat"].upper()
+        self.schema = [field.strip() for field in manifest["fileSchema"].split(",")]
+        self.files = [file["key"] for file in manifest["files"]]
+        self.sorted = {}  # prefix -> sorted entries, see split()
+        self.last_keys = {}  # prefix -> last key the report has under it
+
+        if self.file_format not in ("CSV", "ORC", "PARQUET"):
+            logger.error(f"Unsupported inventory file format {self.file_format}")
+            exit(1)
+        missing = [name for name in REQUIRED_FIELDS if name not in self.schema]
+        if missing:
+            logger.error(
+                f"Inventory {manifest_path} is missing fields {', '.join(missing)}"
+            )
+            exit(1)
+        logger.debug(
+            f"Inventory of s3://{self.source_bucket} from {self.creation_time} "
+            f"({self.file_format}, {len(self.files)} data files)"
+        )
+
+    def open(self, path):
+        s3match = re.match(r"^s3:\/\/([^\/]+)\/(.*)$", path)
+        if s3match:
+            _, body, _, _ = s3api.get_object(s3match.group(1), s3match.group(2))
+            f = tempfile.TemporaryFile()
+            shutil.copyfileobj(body, f)
+            f.seek(0)
+            return f
+        return open(path, "rb")
+
+    def data_path(self, key):
+        if self.s3match:
+            return f"s3://{self.destination_bucket}/{key}"
+        # A local mirror of the destination bucket; search upwards from the
+        # manifest for the directory the data file keys are relative to
+        directory = os.path.dirname(os.path.abspath(self.manifest_path))
+        while True:
+            path = os.path.join(directory, *key.split("/"))
+            if os.path.exists(path):
+                return path
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                break
+            directory = parent
+        return os.path.join(
+            os.path.dirname(self.manifest_path), "data", os.path.basename(key)
+        )
+
+    def read_csv(self, f):
+        fields = {
+            name: self.schema.index(name) for name in COLUMNS if name in self.schema
+        }
+        reader = csv.reader(io.TextIOWrapper(gzip.GzipFile(fileobj=f), newline=""))
+        for row in reader:
+            if "IsLatest" in fields and row[fields["IsLatest"]] != "true":
+                continue
+            if "IsDeleteMarker" in fields and row[fields["IsDeleteMarker"]] == "true":
+                continue
+            yield (
+                urllib.parse.unquote_plus(row[fields["Key"]]),
+                row[fields["ETag"]],
+                int(row[fields["Size"]] or 0),
+                parse_timestamp(row[fields["LastModifiedDate"]]),
+            )
+
+    def read_columnar(self, f):
+        try:
+            import pyarrow.orc
+            import pyarrow.parquet
+        except ImportError:
+            logger.error(
+                f"Python module pyarrow is required to read {self.file_format} inventories"
+            )
+            exit(1)
+
+        columns = [COLUMNS[name] for name in COLUMNS if name in self.schema]
+        if self.file_format == "PARQUET":
+            batches = pyarrow.parquet.ParquetFile(f).iter_batches(columns=columns)
+        else:
+            orc = pyarrow.orc.ORCFile(f)
+            batches = (orc.read_stripe(i, columns=columns) for i in range(orc.nstripes))
+
+        for batch in batches:
+            for row in batch.to_pylist():
+                if row.get("is_latest") is False or row.get("is_delete_marker"):
+                    continue
+                yield (
+                    row["key"],
+                    row["e_tag"],
+                    row["size"] or 0,
+                    parse_timestamp(row["last_modified_date"]),
+                )
+
+    def rows(self):
+        for key in self.files:
+            path = self.data_path(key)
+            logger.debug(f"Reading inventory data file {path}")
+            with self.open(path) as f:
+                if self.file_format == "CSV":
+                    yield from self.read_csv(f)
+                else:
+                    yield from self.read_columnar(f)
+
+    # Reads the report once, sorting the entries under each prefix separately,
+    # so every directory map of the bucket is served by the same pass
+    def split(self, prefixes, max_memory=None):
+        if not prefixes:
+            return
+        if max_memory is not None:
+            max_memory //= max(len(prefixes), 1)
+        else:
+            max_memory = float("inf")  # sorted in memory, never spilled
+        sorters = {prefix: extsort.external_sort(max_memory) for prefix in prefixes}
+        for entry in self.rows():
+            for prefix, sorter in sorters.items():
+                if entry[0].startswith(prefix):
+                    sorter.add(entry)
+        for prefix, sorter in sorters.items():
+            self.sorted[prefix] = sorter
+            self.last_keys[prefix] = sorter.max_key
+        logger.debug(f"Inventory split by {len(prefixes)} prefixes")
+
+    # Sorted entries under a prefix given to split(), which can only be read
+    # once; other prefixes take a pass of their own
+    def entries(self, prefix=""):
+        if prefix not in self.sorted:
+            self.split([prefix])
+        return iter(self.sorted.pop(prefix))
@@ -0,0 +1,246 @@
+# s3-bsync Copyright (c) 2022 Joshua Stockin
+# <https://joshstock.in>
+# <https://git.joshstock.in/s3-bsync>
+#
+# This software is licensed and distributed under the terms of the MIT License.
+# See the MIT License in the LICENSE file of this project's root folder.
+#
+# This comment block and its contents, including this disclaimer, MUST be
+# preserved in all copies or distributions of this software's source.
+
+import os
+import time
+import struct
+import logging
+import concurrent.futures
+
+from .classes import *
+from . import s3api
+from . import sync
+from . import syncfile
+from . import filescan
+from . import concurrency
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["write_plan", "read_totals", "read_plan", "apply_plan"]
+
+
+CONTROL_BYTES = {
+    "SIGNATURE": b"\x9d\x9f\x53\x50",
+    "DIRECTORY_BEGIN": b"\x92",
+    "DIRECTORY_END": b"\x93",
+    "ACTION": b"\x94",
+    "TOTALS": b"\x9a",
+}
+
+CURRENT_VERSION = 1
+ENDIANNESS = "little"
+
+# Planned action: action, key length, etag length (0xFF for no etag), size,
+# local mtime, remote mtime, key, etag
+ACTION_HEADER = struct.Struct("<BHBQQQ")
+NO_ETAG = 0xFF
+
+# Totals trailer: count per action, bytes to transfer, estimated milliseconds
+TOTALS = struct.Struct("<" + "Q" * (len(sync.ACTIONS) + 2))
+
+# Rough sustained rates used for the duration estimate
+ESTIMATED_BYTE_RATE = 32 * 1024 * 1024  # bytes per second
+ESTIMATED_REQUEST_RATE = 50  # requests per second
+
+RUN_BUFFER_SIZE = 64 * 1024
+
+
+def write_action(f, action: sync_action):
+    key = action.key.encode()
+    etag = action.etag.encode() if action.etag is not None else b""
+    f.write(
+        ACTION_HEADER.pack(
+            action.action,
+            len(key),
+            len(etag) if action.etag is not None else NO_ETAG,
+            action.size,
+            action.local_mtime,
+            action.remote_mtime,
+        )
+    )
+    f.write(key + etag)
+
+
+def estimate(totals):
+    requests = sum(totals[name] for name in sync.ACTIONS)
+    seconds = totals["BYTES"] / ESTIMATED_BYTE_RATE + requests / ESTIMATED_REQUEST_RATE
+    return int(seconds * 1000)
+
+
+# Writes the diff of every (bucket, dirmap, actions) given, streaming the
+# actions, and returns the plan's totals
+def write_plan(path, dirmaps):
+    totals = {name: 0 for name in sync.ACTIONS}
+    totals["BYTES"] = 0
+
+    temp_path = path + ".tmp"
+    f = open(temp_path, "wb", buffering=RUN_BUFFER_SIZE)
+    f.write(CONTROL_BYTES["SIGNATURE"])
+    f.write(CURRENT_VERSION.to_bytes(1, byteorder=ENDIANNESS))
+    f.write((time.time_ns() // 1000000).to_bytes(8, byteorder=ENDIANNESS))
+
+    for bucket, dirmap, actions in dirmaps:
+        f.write(CONTROL_BYTES["DIRECTORY_BEGIN"])
+        f.write(bucket.bucket_name.encode() + b"\x00")
+        f.write(dirmap.local_path.encode() + b"\x00")
+        f.write(dirmap.s3_prefix.encode() + b"\x00")
+        for action in actions:
+            f.write(CONTROL_BYTES["ACTION"])
+            write_action(f, action)
+            totals[sync.ACTION_NAMES[action.action]] += 1
+            if action.action in sync.BYTE_ACTIONS:
+                totals["BYTES"] += action.size
+        f.write(CONTROL_BYTES["DIRECTORY_END"])
+        logger.debug(f"Planned directory map {dirmap.local_path}")
+
+    totals["ESTIMATE"] = estimate(totals)
+    f.write(CONTROL_BYTES["TOTALS"])
+    f.write(TOTALS.pack(*totals.values()))
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.replace(temp_path, path)
+    return totals
+
+
+def open_plan(path):
+    f = open(path, "rb", buffering=RUN_BUFFER_SIZE)
+    if f.read(4) != CONTROL_BYTES["SIGNATURE"]:
+        logger.error(f'"{path}" is not an s3sync plan file')
+        exit(1)
+    version = int.from_bytes(f.read(1), byteorder=ENDIANNESS)
+    if version == 0 or version > CURRENT_VERSION:
+        logger.error(f"Plan version outside expected range (1..{CURRENT_VERSION})")
+        exit(1)
+    created = int.from_bytes(f.read(8), byteorder=ENDIANNESS)
+    return f, created
+
+
+def read_totals(path):
+    f, created = open_plan(path)
+    f.seek(-(TOTALS.size + 1), os.SEEK_END)
+    if f.read(1) != CONTROL_BYTES["TOTALS"]:
+        logger.error("Expected plan totals not found (truncated file)")
+        exit(1)
+    values = TOTALS.unpack(f.read(TOTALS.size))
+    f.close()
+    totals = dict(zip([*sync.ACTIONS, "BYTES", "ESTIMATE"], values))
+    return totals, created
+
+
+def read_actions(f):
+    while (b := f.read(1)) == CONTROL_BYTES["ACTION"]:
+        action, key_length, etag_length, size, local_mtime, remote_mtime = (
+            ACTION_HEADER.unpack(f.read(ACTION_HEADER.size))
+        )
+        key = f.read(key_length).decode()
+        etag = None
+        if etag_length != NO_ETAG:
+            etag = f.read(etag_length).decode()
+        yield sync_action(action, key, size, etag, local_mtime, remote_mtime)
+    if b != CONTROL_BYTES["DIRECTORY_END"]:
+        logger.error("Expected directory block end byte not found (corrupt file)")
+        exit(1)
+
+
+# Yields (bucket name, local path, s3 prefix, actions) per directory map; each
+# dirmap's actions must be consumed before the next is read
+def read_plan(path):
+    f, _ = open_plan(path)
+
+    def get_string():
+        return b"".join(iter(lambda: f.read(1), b"\x00")).decode()
+
+    while (b := f.read(1)) == CONTROL_BYTES["DIRECTORY_BEGIN"]:
+        bucket_name = get_string()
+        local_path = get_string()
+        s3_prefix = get_string()
+        yield bucket_name, local_path, s3_prefix, read_actions(f)
+    f.close()
+    if b != CONTROL_BYTES["TOTALS"]:
+        logger.error("Unexpected control byte detected (corrupt file)")
+        exit(1)
+
+
+# The action the current state of a key calls for, from a stat, a HEAD and its
+# tracked record
+def current_action(bucket: sync_managed_bucket, dirmap: sync_directory_map, key):
+    local = filescan.local_entry(dirmap, key)
+    remote = s3api.head_object(bucket.bucket_name, key)
+    fileobject = bucket.fileobjects.get(key)
+    tracked = None
+    if fileobject:
+        tracked = (key, fileobject.etag, fileobject.size, fileobject.modified)
+    return next(
+        sync.diff(
+            [local] if local else [],
+            [remote] if remote else [],
+            [tracked] if tracked else [],
+        ),
+        None,
+    )
+
+
+# Passes on planned actions whose key is still in the state the plan saw;
+# anything changed since is left for the next sync
+def revalidate(bucket: sync_managed_bucket, dirmap: sync_directory_map, actions, stale):
+    with concurrent.futures.ThreadPoolExecutor(concurrency.MAX_WINDOW) as executor:
+        batch = []
+        for action in [*actions, None]:
+            if action is not None:
+                batch.append(action)
+                if len(batch) < sync.MAX_PENDING:
+                    continue
+            currents = executor.map(
+                lambda action: current_action(bucket, dirmap, action.key), batch
+            )
+            for planned, current in zip(batch, currents):
+                if current == planned:
+                    yield planned
+                else:
+                    logger.debug(f"{planned.key} changed since it was planned")
+                    stale.append(planned.key)
+            batch = []
+
+
+def find_dirmap(state, bucket_name, local_path, s3_prefix):
+    for bucket in state.managed_buckets:
+        if bucket.bucket_name != bucket_name:
+            continue
+        for dirmap in bucket.directory_maps:
+            if dirmap.local_path == local_path and dirmap.s3_prefix == s3_prefix:
+                return bucket, dirmap
+    return None, None
+
+
+def apply_plan(state, path, dryrun=False, selection=None):
+    totals = {}
+    for bucket_name, local_path, s3_prefix, actions in read_plan(path):
+        if not syncfile.dirmap_selected(selection, bucket_name, s3_prefix):
+            for _ in actions:
+                pass
+            continue
+        bucket, dirmap = find_dirmap(state, bucket_name, local_path, s3_prefix)
+        if dirmap is None:
+            logger.error(
+                f"Planned directory map {syncfile.dirmap_stringify(local_path, bucket_name, s3_prefix)} is not tracked"
+            )
+            exit(1)
+        logger.debug(
+            f"Applying plan to {syncfile.dirmap_stringify(local_path, bucket_name, s3_prefix)}"
+        )
+        stale = []
+        results = sync.apply(
+            bucket, dirmap, revalidate(bucket, dirmap, actions, stale), dryrun
+        )
+        results["STALE"] = len(stale)
+        for name, count in results.items():
+            totals[name] = totals.get(name, 0) + count
+    return totals
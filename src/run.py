@@ -8,11 +8,19 @@
 # This comment block and its contents, including this disclaimer, MUST be
 # preserved in all copies or distributions of this software's source.
 
+import os
 import logging
 import datetime
 
 from . import syncfile
-from . import filescan
+from . import sync
+from . import watch
+from . import audit
+from . import dedup
+from . import plan
+from . import concurrency
+from . import transfer
+from .inventory import inventory
 from .classes import sync_managed_bucket
 
 logger = logging.getLogger(__name__)
@@ -29,6 +37,7 @@ def purge(state):
 
 def dump(state):
     logger.debug("Running in DUMP mode. Echoing deserialized information to stdout:")
+    buckets = state.merged_buckets()
     print(f"DUMP mode")
     print(
         f'Inputted valid s3sync File "{state.file_path}" (version {state.file_version})'
@@ -37,16 +46,19 @@ def dump(state):
     print(
         f"  Last synced time: {state.last_synced_time} (resolves to {datetime.datetime.fromtimestamp(state.last_synced_time / 1000.0)})"
     )
-    print(f"  Number of tracked buckets:      {len(state.managed_buckets)}")
+    print(f"  Number of tracked buckets:      {len(buckets)}")
     print(
-        f"  Total # of mapped directores:   {sum([len(bucket.directory_maps) for bucket in state.managed_buckets])}"
+        f"  Total # of mapped directores:   {sum([len(bucket.directory_maps) for bucket in buckets])}"
     )
     print(
-        f"  Total # of tracked fileobjects: {sum([len(bucket.fileobjects) for bucket in state.managed_buckets])}"
+        f"  Total # of tracked fileobjects: {sum([len(bucket.fileobjects) for bucket in buckets])}"
+    )
+    print(
+        f"  Total # of pending uploads:     {sum([len(bucket.uploads) for bucket in buckets])}"
     )
     print(f"  Filesize: {state.file_size}")
 
-    for bucket in state.managed_buckets:
+    for bucket in buckets:
         print(f'Bucket "{bucket.bucket_name}"')
         print(f"  # of mapped directores:   {len(bucket.directory_maps)}")
         print(f"  # of tracked fileobjects: {len(bucket.fileobjects)}")
@@ -60,23 +72,67 @@ def dump(state):
                 print(f"    recursive   {dirmap.recursive}")
                 print(f"    gpg_enabled {dirmap.gpg_enabled}")
                 print(f'    gpg_email   "{dirmap.gpg_email}"')
+        if len(bucket.uploads) > 0:
+            print(f"  Pending multipart uploads:")
+            for key in sorted(bucket.uploads):
+                upload = bucket.uploads[key]
+                print(f'  > "{key}"')
+                print(f"    upload_id   {upload.upload_id}")
+                print(
+                    f"    parts       {len(upload.parts)} uploaded ({upload.part_size} bytes each)"
+                )
+                print(
+                    f"    file        {upload.size} bytes, modified {upload.modified}, inode {upload.inode}"
+                )
 
     logger.debug("Finished dump. Exiting...")
     exit(0)
 
 
+def stats(totals):
+    print(f"Transfer stats")
+    for name, count in totals.items():
+        print(f"  {name:<14}{count}")
+    for line in concurrency.report() + transfer.report():
+        print(line)
+
+
+def plan_summary(path):
+    totals, created = plan.read_totals(path)
+    print(f'Plan "{path}"')
+    print(
+        f"  Created: {created} (resolves to {datetime.datetime.fromtimestamp(created / 1000.0)})"
+    )
+    for name in sync.ACTIONS:
+        print(f"  {name:<14}{totals[name]}")
+    print(f'  Bytes to transfer:  {concurrency.format_bytes(totals["BYTES"])}')
+    print(
+        f'  Estimated duration: {datetime.timedelta(seconds=totals["ESTIMATE"] // 1000)}'
+    )
+
+
 def run(settings):
     logger.debug("Entering run sequence")
-    state = syncfile.syncfile(settings.syncfile)
+    selection = getattr(settings, "selection", None)
+    if os.path.isdir(settings.syncfile) or hasattr(settings, "shard_mode"):
+        logger.debug("Using sharded state directory")
+        state = syncfile.sharded_syncfile(
+            settings.syncfile, getattr(settings, "shard_mode", None), selection
+        )
+    else:
+        state = syncfile.syncfile(settings.syncfile)
+
+    state.lock(shared="DUMP" in settings.mode or "AUDIT" in settings.mode)
 
     if "PURGE" in settings.mode:
         purge(state)
 
-    if (
-        state.file_exists() and not "OVERWRITE" in settings.mode
-    ):  # data will be used, not overwritten
-        logger.debug("Syncfile exists. Deserializing...")
-        state.deserialize()
+    if state.file_exists():
+        if "OVERWRITE" in settings.mode:
+            state.clear()
+        else:  # data will be used, not overwritten
+            logger.debug("Syncfile exists. Deserializing...")
+            state.deserialize()
 
     if not state.file_exists() and "INIT" not in settings.mode:
         logger.error("Syncfile is nonexistent; run in INIT mode to create")
@@ -85,6 +141,14 @@ def run(settings):
     if "DUMP" in settings.mode:
         dump(state)
 
+    if "AUDIT" in settings.mode:
+        audit.audit(
+            state,
+            selection,
+            getattr(settings, "rate_limit", None),
+            getattr(settings, "max_memory", None),
+        )
+
     if "INIT" in settings.mode:
         if hasattr(settings, "dirmaps"):
             for local_path in settings.dirmaps:
@@ -94,8 +158,76 @@ def run(settings):
                 state.remove_dirmap(local_path, settings.rmdirs[local_path])
 
     if "SYNC" in settings.mode:
+        dedup.index.build(state.managed_buckets)
+
+    if "WATCH" in settings.mode:
+        watch.watch(
+            state,
+            "DRYRUN" in settings.mode,
+            selection,
+            getattr(settings, "stats", False),
+        )
+    elif hasattr(settings, "plan"):
+        totals = plan.apply_plan(
+            state, settings.plan, "DRYRUN" in settings.mode, selection
+        )
+        if getattr(settings, "stats", False):
+            stats(totals)
+    elif "SYNC" in settings.mode:
+        dirmaps = [
+            (bucket, dirmap)
+            for bucket in state.managed_buckets
+            for dirmap in bucket.directory_maps
+            if syncfile.dirmap_selected(selection, bucket.bucket_name, dirmap.s3_prefix)
+        ]
+        inventories = {}
+        for manifest in getattr(settings, "inventories", []):
+            report = inventory(manifest)
+            inventories[report.source_bucket] = report
+            # One pass over the report for all of the bucket's directory maps,
+            # sorted with half the memory budget (the local scans get the rest)
+            max_memory = getattr(settings, "max_memory", None)
+            report.split(
+                [
+                    dirmap.s3_prefix + "/"
+                    for bucket, dirmap in dirmaps
+                    if bucket.bucket_name == report.source_bucket
+                ],
+                max_memory // 2 if max_memory is not None else None,
+            )
+        if hasattr(settings, "plan_out"):
+            logger.debug("Writing sync plan without making changes")
+            plan.write_plan(
+                settings.plan_out,
+                (
+                    (
+                        bucket,
+                        dirmap,
+                        sync.diff_dirmap(
+                            bucket,
+                            dirmap,
+                            inventories.get(bucket.bucket_name),
+                            getattr(settings, "max_memory", None),
+                        ),
+                    )
+                    for bucket, dirmap in dirmaps
+                ),
+            )
+            plan_summary(settings.plan_out)
+            exit(0)
+        totals = {}
         for bucket in state.managed_buckets:
-            filescan.by_bucket(bucket)
+            results = sync.sync_bucket(
+                bucket,
+                "DRYRUN" in settings.mode,
+                inventories.get(bucket.bucket_name),
+                getattr(settings, "max_memory", None),
+                [d for b, d in dirmaps if b is bucket],
+            )
+            for name, count in results.items():
+                totals[name] = totals.get(name, 0) + count
+        if getattr(settings, "stats", False):
+            stats(totals)
 
     state.serialize()
     exit(0)
@@ -0,0 +1,237 @@
+# s3-bsync Copyright (c) 2022 Joshua Stockin
+# <https://joshstock.in>
+# <https://git.joshstock.in/s3-bsync>
+#
+# This software is licensed and distributed under the terms of the MIT License.
+# See the MIT License in the LICENSE file of this project's root folder.
+#
+# This comment block and its contents, including this disclaimer, MUST be
+# preserved in all copies or distributions of this software's source.
+
+import logging
+import threading
+
+import botocore.session
+import botocore.config
+from botocore.exceptions import ClientError, BotoCoreError
+from botocore.exceptions import ConnectionError, HTTPClientError
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "client",
+    "is_retriable",
+    "list_objects",
+    "head_object",
+    "put_object",
+    "get_object",
+    "delete_object",
+    "copy_object",
+    "create_multipart_upload",
+    "upload_part",
+    "complete_multipart_upload",
+    "abort_multipart_upload",
+    "upload_part_copy",
+    "list_parts",
+]
+
+
+MAX_POOL_CONNECTIONS = 64
+
+# Error codes worth backing off and retrying. Anything else (access denied,
+# missing keys, ...) won't change on a retry.
+RETRIABLE_CODES = [
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "TooManyRequests",
+    "RequestTimeout",
+    "InternalError",
+    "ServiceUnavailable",
+]
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+# botocore is installed alongside aws-cli and reuses its credential chain.
+# Transfers use a client without botocore's own retries so throttling reaches
+# the adaptive concurrency limiter instead of being absorbed here.
+def client(retries=True):
+    with _clients_lock:
+        if retries not in _clients:
+            logger.debug(f"Creating S3 client (retries {retries})")
+            options = {"max_pool_connections": MAX_POOL_CONNECTIONS}
+            if not retries:
+                options["retries"] = {"total_max_attempts": 1}
+            config = botocore.config.Config(**options)
+            session = botocore.session.get_session()
+            _clients[retries] = session.create_client("s3", config=config)
+        return _clients[retries]
+
+
+def is_retriable(e):
+    if isinstance(e, ClientError):
+        error = e.response.get("Error", {})
+        status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return error.get("Code") in RETRIABLE_CODES or status >= 500
+    return isinstance(e, (ConnectionError, HTTPClientError))
+
+
+def strip_etag(etag):
+    return etag.strip('"')
+
+
+def to_millis(timestamp):
+    return int(timestamp.timestamp() * 1000)
+
+
+def list_objects(bucket_name, prefix, start_after=""):
+    paginator = client().get_paginator("list_objects_v2")
+    for page in paginator.paginate(
+        Bucket=bucket_name, Prefix=prefix, StartAfter=start_after
+    ):
+        for obj in page.get("Contents", []):
+            yield (
+                obj["Key"],
+                strip_etag(obj["ETag"]),
+                obj["Size"],
+                to_millis(obj["LastModified"]),
+            )
+
+
+def head_object(bucket_name, key):
+    try:
+        response = client().head_object(Bucket=bucket_name, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+    return (
+        key,
+        strip_etag(response["ETag"]),
+        response["ContentLength"],
+        to_millis(response["LastModified"]),
+    )
+
+
+def put_object(bucket_name, key, body, content_md5=None, content_encoding=None):
+    params = {"Bucket": bucket_name, "Key": key, "Body": body}
+    if content_md5:
+        params["ContentMD5"] = content_md5
+    if content_encoding:
+        params["ContentEncoding"] = content_encoding
+    response = client(retries=False).put_object(**params)
+    return strip_etag(response["ETag"])
+
+
+def get_object(bucket_name, key):
+    response = client(retries=False).get_object(Bucket=bucket_name, Key=key)
+    return (
+        strip_etag(response["ETag"]),
+        response["Body"],
+        response.get("ContentEncoding"),
+        response.get("ContentLength", 0),
+    )
+
+
+def create_multipart_upload(bucket_name, key, content_encoding=None):
+    params = {"Bucket": bucket_name, "Key": key}
+    if content_encoding:
+        params["ContentEncoding"] = content_encoding
+    response = client(retries=False).create_multipart_upload(**params)
+    return response["UploadId"]
+
+
+def upload_part(bucket_name, key, upload_id, part_number, body, content_md5=None):
+    params = {
+        "Bucket": bucket_name,
+        "Key": key,
+        "UploadId": upload_id,
+        "PartNumber": part_number,
+        "Body": body,
+    }
+    if content_md5:
+        params["ContentMD5"] = content_md5
+    response = client(retries=False).upload_part(**params)
+    return strip_etag(response["ETag"])
+
+
+# Copies are made only if the source still has the given ETag
+def copy_object(bucket_name, key, source_bucket, source_key, source_etag):
+    response = client(retries=False).copy_object(
+        Bucket=bucket_name,
+        Key=key,
+        CopySource={"Bucket": source_bucket, "Key": source_key},
+        CopySourceIfMatch=f'"{source_etag}"',
+    )
+    return strip_etag(response["CopyObjectResult"]["ETag"])
+
+
+# Copies bytes first..last of the source object into a part
+def upload_part_copy(
+    bucket_name,
+    key,
+    upload_id,
+    part_number,
+    source_bucket,
+    source_key,
+    first,
+    last,
+    source_etag,
+):
+    response = client(retries=False).upload_part_copy(
+        Bucket=bucket_name,
+        Key=key,
+        UploadId=upload_id,
+        PartNumber=part_number,
+        CopySource={"Bucket": source_bucket, "Key": source_key},
+        CopySourceRange=f"bytes={first}-{last}",
+        CopySourceIfMatch=f'"{source_etag}"',
+    )
+    return strip_etag(response["CopyPartResult"]["ETag"])
+
+
+def complete_multipart_upload(bucket_name, key, upload_id, parts):
+    response = client(retries=False).complete_multipart_upload(
+        Bucket=bucket_name,
+        Key=key,
+        UploadId=upload_id,
+        MultipartUpload={
+            "Parts": [
+                {"PartNumber": number, "ETag": f'"{etag}"'} for number, etag in parts
+            ]
+        },
+    )
+    return strip_etag(response["ETag"])
+
+
+def abort_multipart_upload(bucket_name, key, upload_id):
+    client(retries=False).abort_multipart_upload(
+        Bucket=bucket_name, Key=key, UploadId=upload_id
+    )
+
+
+def delete_object(bucket_name, key):
+    client(retries=False).delete_object(Bucket=bucket_name, Key=key)
+
+
+def list_parts(bucket_name, key, upload_id):
+    parts = {}
+    marker = 0
+    while True:
+        try:
+            response = client().list_parts(
+                Bucket=bucket_name, Key=key, UploadId=upload_id, PartNumberMarker=marker
+            )
+        except ClientError as e:
+            # Completed, aborted, or expired by a lifecycle rule
+            if e.response["Error"]["Code"] in ("404", "NoSuchUpload"):
+                return None
+            raise
+        for part in response.get("Parts", []):
+            parts[part["PartNumber"]] = strip_etag(part["ETag"])
+        if not response.get("IsTruncated"):
+            return parts
+        marker = response["NextPartNumberMarker"]
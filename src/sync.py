@@ -0,0 +1,375 @@
+# s3-bsync Copyright (c) 2022 Joshua Stockin
+# <https://joshstock.in>
+# <https://git.joshstock.in/s3-bsync>
+#
+# This software is licensed and distributed under the terms of the MIT License.
+# See the MIT License in the LICENSE file of this project's root folder.
+#
+# This comment block and its contents, including this disclaimer, MUST be
+# preserved in all copies or distributions of this software's source.
+
+import os
+import re
+import logging
+import functools
+import itertools
+import concurrent.futures
+
+from .classes import *
+from . import s3api
+from . import extsort
+from . import syncfile
+from . import filescan
+from . import transfer
+from . import concurrency
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "diff",
+    "apply",
+    "diff_dirmap",
+    "sync_bucket",
+    "sync_dirmap",
+    "sync_keys",
+]
+
+
+ACTIONS = {
+    "UPLOAD": 1,
+    "DOWNLOAD": 2,
+    "DELETE_LOCAL": 3,
+    "DELETE_REMOTE": 4,
+    "TRACK": 5,
+    "UNTRACK": 6,
+}
+
+ACTION_NAMES = {value: name for name, value in ACTIONS.items()}
+
+MAX_PENDING = concurrency.MAX_WINDOW * 2
+
+BYTE_ACTIONS = [ACTIONS["UPLOAD"], ACTIONS["DOWNLOAD"]]
+
+TRANSFERS = {
+    ACTIONS["UPLOAD"]: transfer.upload,
+    ACTIONS["DOWNLOAD"]: transfer.download,
+    ACTIONS["DELETE_LOCAL"]: transfer.delete_local,
+    ACTIONS["DELETE_REMOTE"]: transfer.delete_remote,
+}
+
+# Transfers of files under transfer.SMALL_FILE_SIZE are grouped into batches
+BATCHES = {
+    ACTIONS["UPLOAD"]: transfer.upload_batch,
+    ACTIONS["DOWNLOAD"]: transfer.download_batch,
+}
+
+
+def compare(local, remote, tracked):
+    if tracked is None:
+        if local and remote:
+            if local[2] == remote[2]:
+                return ACTIONS["TRACK"]
+            return ACTIONS["UPLOAD"] if local[3] > remote[3] else ACTIONS["DOWNLOAD"]
+        if local:
+            return ACTIONS["UPLOAD"]
+        if remote:
+            return ACTIONS["DOWNLOAD"]
+        return None
+
+    if not local and not remote:
+        return ACTIONS["UNTRACK"]
+
+    local_changed = not local or (local[2], local[3]) != (tracked[2], tracked[3])
+    remote_changed = not remote or remote[1] != tracked[1]
+
+    if not local:
+        return ACTIONS["DOWNLOAD"] if remote_changed else ACTIONS["DELETE_REMOTE"]
+    if not remote:
+        return ACTIONS["UPLOAD"] if local_changed else ACTIONS["DELETE_LOCAL"]
+    if local_changed and remote_changed:
+        # Newer copy wins; the bucket takes precedence on a tie
+        return ACTIONS["UPLOAD"] if local[3] > remote[3] else ACTIONS["DOWNLOAD"]
+    if local_changed:
+        return ACTIONS["UPLOAD"]
+    if remote_changed:
+        return ACTIONS["DOWNLOAD"]
+    return None
+
+
+# refresh, if given, may replace the remote entry of each key before it's
+# compared
+def diff(local, remote, tracked, refresh=None):
+    for key, l, r, t in extsort.merge(local, remote, tracked):
+        if refresh is not None:
+            r = refresh(key, l, r, t)
+        action = compare(l, r, t)
+        if action is None:
+            continue
+        # The size of the copy being transferred (or deleted)
+        if action == ACTIONS["DOWNLOAD"]:
+            size = (r or l or t)[2]
+        else:
+            size = (l or r or t)[2]
+        yield sync_action(
+            action,
+            key,
+            size,
+            (r or t)[1] if (r or t) else None,
+            l[3] if l else 0,
+            r[3] if r else 0,
+        )
+
+
+def record(bucket: sync_managed_bucket, key, entry):
+    if entry is None:
+        bucket.remove_fileobject(key)
+    else:
+        bucket.create_fileobject(key, entry[3], entry[1], entry[2], *entry[4:])
+
+
+# An untracked key on both hosts with the same size is only tracked when the
+# local file hashes to the object's ETag. Otherwise (or when the ETag isn't a
+# plain MD5) the newer copy wins, as with any other conflict.
+def resolve_track(dirmap: sync_directory_map, action):
+    if dirmap.gz_compress == 0 and re.fullmatch("[0-9a-f]{32}", action.etag or ""):
+        path = filescan.path_from_key(dirmap, action.key)
+        try:
+            with transfer.file_view(path) as (view, _, _):
+                digest = transfer.hash_view(view).hex()
+        except OSError:
+            # Gone since it was scanned; nothing is recorded for it
+            return action
+        if digest == action.etag:
+            return action
+    if action.local_mtime > action.remote_mtime:
+        action.action = ACTIONS["UPLOAD"]
+    else:
+        action.action = ACTIONS["DOWNLOAD"]
+    return action
+
+
+def apply(
+    bucket: sync_managed_bucket, dirmap: sync_directory_map, actions, dryrun=False
+):
+    results = {name: 0 for name in ACTIONS}
+    results["FAILED"] = 0
+    futures = {}
+    batches = {action: [] for action in BATCHES}
+
+    def collect(done):
+        for future in done:
+            actions = futures.pop(future)
+            if isinstance(actions, list):
+                # A batch's records are committed together once it completes
+                by_key = {action.key: action for action in actions}
+                outcomes = [(by_key[key], entry) for key, entry in future.result()]
+            else:
+                try:
+                    outcomes = [(actions, future.result())]
+                except (OSError, s3api.ClientError, s3api.BotoCoreError) as e:
+                    outcomes = [(actions, e)]
+            for action, entry in outcomes:
+                if isinstance(entry, Exception):
+                    logger.error(
+                        f"{ACTION_NAMES[action.action]} s3://{bucket.bucket_name}/{action.key} failed: {entry}"
+                    )
+                    results["FAILED"] += 1
+                    continue
+                record(bucket, action.key, entry)
+                results[ACTION_NAMES[action.action]] += 1
+
+    def wait(limit):
+        # Keep the diff streaming instead of queueing every transfer
+        while len(futures) > limit:
+            done, _ = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            collect(done)
+
+    def submit_batch(executor, action):
+        batch = batches[action]
+        batches[action] = []
+        future = executor.submit(BATCHES[action], bucket, dirmap, batch)
+        futures[future] = batch
+        wait(MAX_PENDING - 1)
+
+    with concurrent.futures.ThreadPoolExecutor(concurrency.MAX_WINDOW) as executor:
+        for action in actions:
+            if action.action == ACTIONS["TRACK"]:
+                action = resolve_track(dirmap, action)
+            name = ACTION_NAMES[action.action]
+            logger.debug(f"{name} s3://{bucket.bucket_name}/{action.key}")
+            if dryrun:
+                results[name] += 1
+                continue
+            if action.action != ACTIONS["UPLOAD"] and action.key in bucket.uploads:
+                # The file an interrupted upload was sending is gone or stale
+                try:
+                    transfer.abort_upload(bucket, action.key)
+                except (s3api.ClientError, s3api.BotoCoreError) as e:
+                    logger.error(f"Unable to abort upload of {action.key}: {e}")
+            if action.action == ACTIONS["TRACK"]:
+                entry = filescan.local_entry(dirmap, action.key)
+                if entry:
+                    record(bucket, action.key, (action.key, action.etag, *entry[2:]))
+                results[name] += 1
+            elif action.action == ACTIONS["UNTRACK"]:
+                record(bucket, action.key, None)
+                results[name] += 1
+            elif action.action in BATCHES and action.size < transfer.SMALL_FILE_SIZE:
+                batch = batches[action.action]
+                batch.append(action)
+                if (
+                    len(batch) >= transfer.BATCH_FILES
+                    or sum(a.size for a in batch) >= transfer.BATCH_BYTES
+                ):
+                    submit_batch(executor, action.action)
+            else:
+                future = executor.submit(
+                    concurrency.limiter.call,
+                    bucket.bucket_name,
+                    filescan.key_prefix(dirmap, action.key),
+                    action.size if action.action in BYTE_ACTIONS else 0,
+                    s3api.is_retriable,
+                    TRANSFERS[action.action],
+                    bucket,
+                    dirmap,
+                    action.key,
+                )
+                futures[future] = action
+                wait(MAX_PENDING - 1)
+
+        for action, batch in batches.items():
+            if batch:
+                submit_batch(executor, action)
+        collect(concurrent.futures.as_completed(list(futures)))
+
+    return results
+
+
+def local_root_exists(dirmap: sync_directory_map):
+    # A missing local directory (an unmounted disk, a renamed directory) would
+    # otherwise look like every tracked file was deleted locally
+    if os.path.isdir(dirmap.local_path):
+        return True
+    logger.error(
+        f"Local directory {dirmap.local_path} doesn't exist; skipping its directory map"
+    )
+    return False
+
+
+def peek(scan):
+    scan = iter(scan)
+    first = next(scan, None)
+    if first is None:
+        return True, scan
+    return False, itertools.chain([first], scan)
+
+
+def diff_dirmap(
+    bucket: sync_managed_bucket,
+    dirmap: sync_directory_map,
+    inventory=None,
+    max_memory=None,
+):
+    if not local_root_exists(dirmap):
+        return iter(())
+    # The inventory report was sorted with the other half of the budget
+    if max_memory is not None and inventory is not None:
+        max_memory //= 2
+    local = filescan.local_scan(dirmap, max_memory)
+    remote = filescan.remote_scan(bucket.bucket_name, dirmap, inventory)
+    tracked = filescan.tracked_scan(bucket, dirmap)
+    refresh = None
+    if inventory is not None:
+        refresh = functools.partial(
+            filescan.refresh_stale,
+            bucket.bucket_name,
+            inventory.last_keys.get(dirmap.s3_prefix + "/"),
+        )
+    # Deleting every tracked key of a directory map in one run is refused; one
+    # side emptied out is far more likely a mistake than intended
+    local_empty, local = peek(local)
+    remote_empty, remote = peek(remote)
+    if local_empty != remote_empty and any(
+        filescan.key_in_dirmap(dirmap, key) for key in bucket.fileobjects
+    ):
+        if local_empty:
+            logger.error(
+                f"Local directory {dirmap.local_path} is empty but has tracked "
+                "files; refusing to delete them all from the bucket"
+            )
+        else:
+            logger.error(
+                f"s3://{bucket.bucket_name}/{dirmap.s3_prefix}/ is empty but has "
+                "tracked files; refusing to delete them all locally"
+            )
+        return iter(())
+    return diff(local, remote, tracked, refresh)
+
+
+def sync_dirmap(
+    bucket: sync_managed_bucket,
+    dirmap: sync_directory_map,
+    dryrun=False,
+    inventory=None,
+    max_memory=None,
+):
+    logger.debug(
+        f"Syncing directory map {syncfile.dirmap_stringify(dirmap.local_path, bucket.bucket_name, dirmap.s3_prefix)}"
+    )
+    return apply(
+        bucket, dirmap, diff_dirmap(bucket, dirmap, inventory, max_memory), dryrun
+    )
+
+
+def sync_keys(
+    bucket: sync_managed_bucket,
+    dirmap: sync_directory_map,
+    keys,
+    remote=None,
+    dryrun=False,
+):
+    if not local_root_exists(dirmap):
+        return apply(bucket, dirmap, [], dryrun)
+    keys = sorted(key for key in set(keys) if filescan.key_in_dirmap(dirmap, key))
+    local = []
+    remote_entries = []
+    tracked = []
+    for key in keys:
+        entry = filescan.local_entry(dirmap, key)
+        if entry:
+            local.append(entry)
+        if remote is not None:
+            entry = remote.get(key)
+        else:
+            entry = s3api.head_object(bucket.bucket_name, key)
+        if entry:
+            remote_entries.append(entry)
+        fileobject = bucket.fileobjects.get(key)
+        if fileobject:
+            tracked.append(
+                (fileobject.key, fileobject.etag, fileobject.size, fileobject.modified)
+            )
+    return apply(bucket, dirmap, diff(local, remote_entries, tracked), dryrun)
+
+
+def sync_bucket(
+    bucket: sync_managed_bucket,
+    dryrun=False,
+    inventory=None,
+    max_memory=None,
+    dirmaps=None,
+):
+    if dirmaps is None:
+        dirmaps = bucket.directory_maps
+    totals = {}
+    for dirmap in dirmaps:
+        results = sync_dirmap(bucket, dirmap, dryrun, inventory, max_memory)
+        for name, count in results.items():
+            totals[name] = totals.get(name, 0) + count
+        logger.debug(
+            f"Directory map {dirmap.local_path} synced: "
+            + ", ".join(f"{name} {count}" for name, count in results.items() if count)
+        )
+    return totals
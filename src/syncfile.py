@@ -11,13 +11,17 @@
 import os
 import time
 import re
+import glob
+import fcntl
+import hashlib
 import logging
+import threading
 
 from .classes import *
 
 logger = logging.getLogger(__name__)
 
-__all__ = ["syncfile", "dirmap_stringify"]
+__all__ = ["syncfile", "sharded_syncfile", "dirmap_stringify", "parse_s3_path"]
 
 
 CONTROL_BYTES = {
@@ -30,18 +34,55 @@ CONTROL_BYTES = {
     "OBJECT_END": b"\x95",
     "ETAG_MD5": b"\x96",
     "ETAG_OTHER": b"\x97",
+    "UPLOAD_BEGIN": b"\x98",
+    "UPLOAD_END": b"\x99",
+    "PART_DIGESTS": b"\x9c",
     "METADATA_BEGIN": b"\x9A",
     "METADATA_END": b"\x9B",
 }
 
-CURRENT_VERSION = 1
+CURRENT_VERSION = 2
 ENDIANNESS = "little"
 
+# Sidecar holding multipart uploads in progress, rewritten as parts complete
+UPLOADS_SUFFIX = ".uploads"
+
+WRITE_BUFFER_SIZE = 64 * 1024
+
 
 def dirmap_stringify(local_path, bucket_name, s3_prefix):
     return f'"{local_path}" <=> "s3://{bucket_name}/{s3_prefix}"'
 
 
+def parse_s3_path(s3_path):
+    # Check S3 path supplied is valid
+    s3match = re.match("^s3:\/\/([a-z0-9][a-z0-9-]{1,61}[a-z0-9])\/(.*)$", s3_path)
+    if not s3match or len(s3match.groups()) != 2:
+        logger.error(f'User supplied invalid S3 path ("{s3_path}")')
+        exit(1)
+    bucket_name = s3match.group(1)
+    s3_prefix = s3match.group(2)
+    if s3_prefix.endswith("/") or len(s3_prefix) == 0:
+        logger.error(f'User supplied invalid S3 path prefix ("{s3_prefix}")')
+        exit(1)
+    return bucket_name, s3_prefix
+
+
+def dirmap_selected(selection, bucket_name, s3_prefix):
+    if selection is None:
+        return True
+    for selected_bucket, selected_prefix in selection:
+        if selected_bucket != bucket_name:
+            continue
+        if (
+            not selected_prefix
+            or s3_prefix == selected_prefix
+            or s3_prefix.startswith(selected_prefix + "/")
+        ):
+            return True
+    return False
+
+
 class syncfile:
     file_path = None
     file_version = 0
@@ -51,6 +92,38 @@ class syncfile:
 
     def __init__(self, state_file: str):
         self.file_path = state_file
+        self.managed_buckets = []
+        self.lock_file = None
+        self.uploads_path = state_file + UPLOADS_SUFFIX
+        self.uploads_lock = threading.Lock()
+
+    # Held from deserialization until the process exits so that concurrent
+    # runs against the same file serialize their read-modify-write cycles
+    def lock(self, shared=False):
+        if self.lock_file is not None:
+            return
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        self.lock_file = open(self.file_path + ".lock", "a+b")
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(self.lock_file, operation | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.debug(f"Waiting for lock on {self.file_path}")
+            fcntl.flock(self.lock_file, operation)
+        logger.debug(f"Locked {self.file_path} ({'shared' if shared else 'exclusive'})")
+
+    def unlock(self):
+        if self.lock_file is None:
+            return
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+        self.lock_file = None
+
+    def merged_buckets(self):
+        return self.managed_buckets
+
+    def clear(self):
+        self.managed_buckets = []
 
     def map_directory(self, local_path, s3_path):
         # Verify local path validity
@@ -60,16 +133,7 @@ class syncfile:
             )
             exit(1)
 
-        # Check S3 path supplied is valid
-        s3match = re.match("^s3:\/\/([a-z0-9][a-z0-9-]{1,61}[a-z0-9])\/(.*)$", s3_path)
-        if not s3match or len(s3match.groups()) != 2:
-            logger.error(f'User supplied invalid S3 path ("{s3_path}")')
-            exit(1)
-        bucket_name = s3match.group(1)
-        s3_prefix = s3match.group(2)
-        if s3_prefix.endswith("/") or len(s3_prefix) == 0:
-            logger.error(f'User supplied invalid S3 path prefix ("{s3_prefix}")')
-            exit(1)
+        bucket_name, s3_prefix = parse_s3_path(s3_path)
 
         logger.debug(
             f'Local directory "{local_path}" mapped to bucket "{bucket_name}" at path prefix "{s3_prefix}"'
@@ -81,6 +145,7 @@ class syncfile:
 
         if not bucket:
             bucket = sync_managed_bucket(bucket_name)
+            bucket.save_uploads = self.save_uploads
             self.managed_buckets.append(bucket)
 
         dirmap_exists = next(
@@ -104,16 +169,7 @@ class syncfile:
         bucket.create_dirmap(local_path, s3_prefix)
 
     def remove_dirmap(self, local_path, s3_path):
-        # Check S3 path supplied is valid
-        s3match = re.match("^s3:\/\/([a-z0-9][a-z0-9-]{1,61}[a-z0-9])\/(.*)$", s3_path)
-        if not s3match or len(s3match.groups()) != 2:
-            logger.error(f'User supplied invalid S3 path ("{s3_path}")')
-            exit(1)
-        bucket_name = s3match.group(1)
-        s3_prefix = s3match.group(2)
-        if s3_prefix.endswith("/") or len(s3_prefix) == 0:
-            logger.error(f'User supplied invalid S3 path prefix ("{s3_prefix}")')
-            exit(1)
+        bucket_name, s3_prefix = parse_s3_path(s3_path)
 
         bucket = next(
             (
@@ -154,6 +210,8 @@ class syncfile:
         if self.file_exists():
             if self.verify_file():
                 os.remove(self.file_path)
+                if os.path.exists(self.uploads_path):
+                    os.remove(self.uploads_path)
             else:
                 logger.error("Attempt to purge (delete) a non-s3sync file")
                 exit(1)
@@ -173,17 +231,19 @@ class syncfile:
         return True
 
     def serialize(self):
-        logger.debug("Compiling bytearray")
-
-        b = bytearray()
+        # Records are written to the file as they're encoded rather than
+        # compiled into one buffer first. Write to a temporary file and rename
+        # over the original so readers never see a partially written state file
+        temp_path = self.file_path + ".tmp"
+        f = open(temp_path, "wb", buffering=WRITE_BUFFER_SIZE)
 
-        b += CONTROL_BYTES["SIGNATURE"]
-        b += CURRENT_VERSION.to_bytes(1, byteorder=ENDIANNESS)
+        f.write(CONTROL_BYTES["SIGNATURE"])
+        f.write(CURRENT_VERSION.to_bytes(1, byteorder=ENDIANNESS))
 
-        b += CONTROL_BYTES["METADATA_BEGIN"]
+        f.write(CONTROL_BYTES["METADATA_BEGIN"])
         current_time = time.time_ns() // 1000000
-        b += current_time.to_bytes(8, byteorder=ENDIANNESS)
-        b += CONTROL_BYTES["METADATA_END"]
+        f.write(current_time.to_bytes(8, byteorder=ENDIANNESS))
+        f.write(CONTROL_BYTES["METADATA_END"])
 
         for bucket in self.managed_buckets:
             if (
@@ -191,52 +251,64 @@ class syncfile:
             ):  # Don't serialize any buckets with no dirmaps
                 continue
 
-            b += CONTROL_BYTES["BUCKET_BEGIN"]
-            b += bucket.bucket_name.encode() + b"\x00"
+            f.write(CONTROL_BYTES["BUCKET_BEGIN"])
+            f.write(bucket.bucket_name.encode() + b"\x00")
 
             logger.debug(f"Bucket {bucket.bucket_name}")
 
             for dirmap in bucket.directory_maps:
-                b += CONTROL_BYTES["DIRECTORY_BEGIN"]
-                b += dirmap.local_path.encode() + b"\x00"
-                b += dirmap.s3_prefix.encode() + b"\x00"
-                b += dirmap.gz_compress.to_bytes(1, byteorder=ENDIANNESS)
-                b += dirmap.recursive.to_bytes(1, byteorder=ENDIANNESS)
-                b += dirmap.gpg_enabled.to_bytes(1, byteorder=ENDIANNESS)
+                f.write(CONTROL_BYTES["DIRECTORY_BEGIN"])
+                f.write(dirmap.local_path.encode() + b"\x00")
+                f.write(dirmap.s3_prefix.encode() + b"\x00")
+                f.write(dirmap.gz_compress.to_bytes(1, byteorder=ENDIANNESS))
+                f.write(dirmap.recursive.to_bytes(1, byteorder=ENDIANNESS))
+                f.write(dirmap.gpg_enabled.to_bytes(1, byteorder=ENDIANNESS))
                 if dirmap.gpg_enabled:
-                    b += dirmap.gpg_email.encode() + b"\x00"
-                b += CONTROL_BYTES["DIRECTORY_END"]
+                    f.write(dirmap.gpg_email.encode() + b"\x00")
+                f.write(CONTROL_BYTES["DIRECTORY_END"])
                 logger.debug(
                     f"Serialized directory map {dirmap_stringify(dirmap.local_path, bucket.bucket_name, dirmap.s3_prefix)}"
                 )
 
-            for fileobject in bucket.fileobjects:
-                b += CONTROL_BYTES["OBJECT_BEGIN"]
-                b += fileobject.key.encode() + b"\x00"
-                b += fileobject.modified.to_bytes(8, byteorder=ENDIANNESS)
-                if fileobject and len(fileobject.etag) == 16:
-                    b += CONTROL_BYTES["ETAG_MD5"]
-                    b += bytes.fromhex(fileobject.etag)
+            for key in sorted(bucket.fileobjects):
+                fileobject = bucket.fileobjects[key]
+                f.write(CONTROL_BYTES["OBJECT_BEGIN"])
+                f.write(fileobject.key.encode() + b"\x00")
+                f.write(fileobject.modified.to_bytes(8, byteorder=ENDIANNESS))
+                if re.fullmatch("[0-9a-f]{32}", fileobject.etag):
+                    f.write(CONTROL_BYTES["ETAG_MD5"])
+                    f.write(bytes.fromhex(fileobject.etag))
                 else:
-                    b += CONTROL_BYTES["ETAG_OTHER"]
-                    b += fileobject.etag.encode() + b"\x00"
-                b += fileobject.size.to_bytes(8, byteorder=ENDIANNESS)
-                b += CONTROL_BYTES["OBJECT_END"]
+                    f.write(CONTROL_BYTES["ETAG_OTHER"])
+                    f.write(fileobject.etag.encode() + b"\x00")
+                f.write(fileobject.size.to_bytes(8, byteorder=ENDIANNESS))
+                if fileobject.part_digests:
+                    f.write(CONTROL_BYTES["PART_DIGESTS"])
+                    f.write(fileobject.part_size.to_bytes(8, byteorder=ENDIANNESS))
+                    f.write(
+                        len(fileobject.part_digests).to_bytes(2, byteorder=ENDIANNESS)
+                    )
+                    for digest in fileobject.part_digests:
+                        f.write(bytes.fromhex(digest))
+                f.write(CONTROL_BYTES["OBJECT_END"])
                 logger.debug(
-                    f"Serialized fileobject s3://{bucket.name}/{fileobject.key} ({fileobject.etag})"
+                    f"Serialized fileobject s3://{bucket.bucket_name}/{fileobject.key} ({fileobject.etag})"
                 )
 
-            b += CONTROL_BYTES["BUCKET_END"]
+            f.write(CONTROL_BYTES["BUCKET_END"])
 
-        logger.debug("Writing serialized state information to syncfile")
-        f = open(self.file_path, "wb")
-        f.seek(0)
-        f.write(b)
-        f.truncate()
+        length = f.tell()
+        f.flush()
+        os.fsync(f.fileno())
         f.close()
-        logger.debug(f"Finished writing to file (length {len(b)})")
-
-    def deserialize(self):
+        os.replace(temp_path, self.file_path)
+        logger.debug(f"Finished writing to file (length {length})")
+        self.save_uploads()
+
+    # With dirmaps_only, reading stops at the first object record. A bucket's
+    # directory maps come before its objects, so this gives every directory
+    # map of a single bucket file (as shards are) without reading its objects.
+    def deserialize(self, dirmaps_only=False):
         if not self.file_exists():
             logger.error("Attempt to deserialize file that doesn't exist")
             exit(1)
@@ -282,6 +354,7 @@ class syncfile:
                 exit(1)
             bucket_name = get_string()
             bucket = sync_managed_bucket(bucket_name)
+            bucket.save_uploads = self.save_uploads
             self.managed_buckets.append(bucket)
 
             logger.debug(f"Bucket {bucket_name}")
@@ -314,23 +387,36 @@ class syncfile:
                     )
 
                 elif b2 == CONTROL_BYTES["OBJECT_BEGIN"]:
+                    if dirmaps_only:
+                        f.close()
+                        return
                     key = get_string()
                     modified = int.from_bytes(f.read(8), byteorder=ENDIANNESS)
                     etag_type = f.read(1)
                     etag = ""
                     if etag_type == CONTROL_BYTES["ETAG_MD5"]:
-                        etag = f.read(16)
+                        etag = f.read(16).hex()
                     elif etag_type == CONTROL_BYTES["ETAG_OTHER"]:
                         etag = get_string()
-                    file_size = int.form_bytes(f.read(8), byteorder=ENDIANNESS)
-                    if f.read(1) != CONTROL_BYTES["OBJECT_END"]:
+                    file_size = int.from_bytes(f.read(8), byteorder=ENDIANNESS)
+                    part_size = 0
+                    part_digests = []
+                    b3 = f.read(1)
+                    if b3 == CONTROL_BYTES["PART_DIGESTS"]:
+                        part_size = int.from_bytes(f.read(8), byteorder=ENDIANNESS)
+                        count = int.from_bytes(f.read(2), byteorder=ENDIANNESS)
+                        part_digests = [f.read(16).hex() for _ in range(count)]
+                        b3 = f.read(1)
+                    if b3 != CONTROL_BYTES["OBJECT_END"]:
                         logger.error(
                             "Expected fileobject block end byte not found (corrupt file)"
                         )
                         exit(1)
-                    bucket.create_fileobject(key, modified, etag, file_size)
+                    bucket.create_fileobject(
+                        key, modified, etag, file_size, part_size, part_digests
+                    )
                     logger.debug(
-                        f"Deserialized fileobject s3://{bucket.name}/{key} ({etag})"
+                        f"Deserialized fileobject s3://{bucket.bucket_name}/{key} ({etag})"
                     )
 
                 elif b2 == CONTROL_BYTES["BUCKET_END"]:
@@ -340,3 +426,255 @@ class syncfile:
                     logger.error("Unexpected control byte detected (corrupt file)")
 
         f.close()
+        self.load_uploads()
+
+    # Called from transfer threads whenever a multipart upload starts, completes
+    # a part or finishes, so an interrupted upload can resume on the next run
+    def save_uploads(self):
+        with self.uploads_lock:
+            b = bytearray()
+            for bucket in self.managed_buckets:
+                for upload in list(bucket.uploads.values()):
+                    parts = upload.parts
+                    b += CONTROL_BYTES["UPLOAD_BEGIN"]
+                    b += bucket.bucket_name.encode() + b"\x00"
+                    b += upload.key.encode() + b"\x00"
+                    b += upload.upload_id.encode() + b"\x00"
+                    b += upload.size.to_bytes(8, byteorder=ENDIANNESS)
+                    b += upload.modified.to_bytes(8, byteorder=ENDIANNESS)
+                    b += upload.inode.to_bytes(8, byteorder=ENDIANNESS)
+                    b += upload.part_size.to_bytes(8, byteorder=ENDIANNESS)
+                    b += upload.compressed.to_bytes(1, byteorder=ENDIANNESS)
+                    b += len(parts).to_bytes(2, byteorder=ENDIANNESS)
+                    for number, etag in sorted(parts.items()):
+                        b += number.to_bytes(2, byteorder=ENDIANNESS)
+                        if re.fullmatch("[0-9a-f]{32}", etag):
+                            b += CONTROL_BYTES["ETAG_MD5"]
+                            b += bytes.fromhex(etag)
+                        else:
+                            b += CONTROL_BYTES["ETAG_OTHER"]
+                            b += etag.encode() + b"\x00"
+                    b += CONTROL_BYTES["UPLOAD_END"]
+
+            if not b:
+                if os.path.exists(self.uploads_path):
+                    os.remove(self.uploads_path)
+                return
+
+            temp_path = self.uploads_path + ".tmp"
+            f = open(temp_path, "wb")
+            f.write(CONTROL_BYTES["SIGNATURE"])
+            f.write(CURRENT_VERSION.to_bytes(1, byteorder=ENDIANNESS))
+            f.write(b)
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.replace(temp_path, self.uploads_path)
+
+    def load_uploads(self):
+        if not os.path.exists(self.uploads_path):
+            return
+        f = open(self.uploads_path, "rb")
+
+        def get_string():
+            return b"".join(iter(lambda: f.read(1), b"\x00")).decode()
+
+        def get_int(length):
+            return int.from_bytes(f.read(length), byteorder=ENDIANNESS)
+
+        if f.read(4) != CONTROL_BYTES["SIGNATURE"] or not (
+            1 <= get_int(1) <= CURRENT_VERSION
+        ):
+            logger.error(
+                f"Ignoring unreadable upload sessions file {self.uploads_path}"
+            )
+            f.close()
+            return
+
+        buckets = {bucket.bucket_name: bucket for bucket in self.managed_buckets}
+        while b := f.read(1):
+            if b != CONTROL_BYTES["UPLOAD_BEGIN"]:
+                logger.error("Unexpected control byte detected (corrupt file)")
+                exit(1)
+            bucket_name = get_string()
+            key = get_string()
+            upload_id = get_string()
+            size, modified, inode, part_size = (get_int(8) for _ in range(4))
+            compressed = bool(get_int(1))
+            parts = {}
+            for _ in range(get_int(2)):
+                number = get_int(2)
+                if f.read(1) == CONTROL_BYTES["ETAG_MD5"]:
+                    parts[number] = f.read(16).hex()
+                else:
+                    parts[number] = get_string()
+            if f.read(1) != CONTROL_BYTES["UPLOAD_END"]:
+                logger.error("Expected upload block end byte not found (corrupt file)")
+                exit(1)
+            if bucket_name not in buckets:
+                logger.debug(f"Upload session for untracked bucket {bucket_name}")
+                continue
+            upload = buckets[bucket_name].create_upload(
+                key, upload_id, size, modified, inode, part_size, compressed
+            )
+            upload.parts = parts
+            logger.debug(
+                f"Deserialized upload session s3://{bucket_name}/{key} ({len(parts)} parts)"
+            )
+
+        f.close()
+
+
+SHARD_MODES = ["bucket", "dirmap"]
+SHARD_MODE_FILE = ".shard-mode"
+SHARD_SUFFIX = ".s3sync"
+
+
+class sharded_syncfile:
+    file_path = None
+    file_version = CURRENT_VERSION
+    shard_mode = None
+
+    def __init__(self, state_dir: str, shard_mode=None, selection=None):
+        self.file_path = state_dir
+        self.selection = selection
+        self.shared = False
+        self.shards = {}
+
+        mode_path = os.path.join(state_dir, SHARD_MODE_FILE)
+        if os.path.exists(mode_path):
+            with open(mode_path) as f:
+                self.shard_mode = f.read().strip()
+            if shard_mode and shard_mode != self.shard_mode:
+                logger.error(
+                    f'State directory is sharded by {self.shard_mode}, not "{shard_mode}"'
+                )
+                exit(1)
+        else:
+            self.shard_mode = shard_mode or "bucket"
+
+    @property
+    def managed_buckets(self):
+        return [
+            bucket
+            for name in sorted(self.shards)
+            for bucket in self.shards[name].managed_buckets
+        ]
+
+    @property
+    def last_synced_time(self):
+        return max((s.last_synced_time for s in self.shards.values()), default=0)
+
+    @property
+    def file_size(self):
+        return sum(s.file_size for s in self.shards.values())
+
+    def merged_buckets(self):
+        buckets = {}
+        for bucket in self.managed_buckets:
+            if bucket.bucket_name not in buckets:
+                buckets[bucket.bucket_name] = sync_managed_bucket(bucket.bucket_name)
+            merged = buckets[bucket.bucket_name]
+            merged.directory_maps += bucket.directory_maps
+            merged.fileobjects.update(bucket.fileobjects)
+            merged.uploads.update(bucket.uploads)
+        return list(buckets.values())
+
+    def shard_name(self, bucket_name, local_path, s3_prefix):
+        if self.shard_mode == "bucket":
+            return bucket_name
+        digest = hashlib.sha1(f"{local_path}\x00{s3_prefix}".encode()).hexdigest()
+        return f"{bucket_name}.{digest[:16]}"
+
+    def shard(self, name):
+        if name not in self.shards:
+            shard = syncfile(os.path.join(self.file_path, name + SHARD_SUFFIX))
+            shard.lock(self.shared)
+            if shard.file_exists():
+                shard.deserialize()
+            self.shards[name] = shard
+        return self.shards[name]
+
+    def map_directory(self, local_path, s3_path):
+        bucket_name, s3_prefix = parse_s3_path(s3_path)
+        name = self.shard_name(bucket_name, local_path, s3_prefix)
+        self.shard(name).map_directory(local_path, s3_path)
+
+    def remove_dirmap(self, local_path, s3_path):
+        bucket_name, s3_prefix = parse_s3_path(s3_path)
+        name = self.shard_name(bucket_name, local_path, s3_prefix)
+        if not os.path.exists(os.path.join(self.file_path, name + SHARD_SUFFIX)):
+            logger.error(
+                f"Directory map {dirmap_stringify(local_path, bucket_name, s3_prefix)} does not exist"
+            )
+            exit(1)
+        self.shard(name).remove_dirmap(local_path, s3_path)
+
+    def file_exists(self):
+        return os.path.isdir(self.file_path)
+
+    def shard_paths(self):
+        return sorted(
+            glob.glob(os.path.join(glob.escape(self.file_path), "*" + SHARD_SUFFIX))
+        )
+
+    def purge(self):
+        if not self.file_exists():
+            logger.error("State directory nonexistent")
+            exit(1)
+        for path in self.shard_paths():
+            shard = syncfile(path)
+            shard.lock()
+            shard.purge()
+            shard.unlock()
+            os.remove(path + ".lock")
+        mode_path = os.path.join(self.file_path, SHARD_MODE_FILE)
+        if os.path.exists(mode_path):
+            os.remove(mode_path)
+        os.rmdir(self.file_path)
+
+    # Shards are locked as they are loaded rather than up front
+    def lock(self, shared=False):
+        self.shared = shared
+
+    def clear(self):
+        for path in self.shard_paths():
+            shard = syncfile(path)
+            shard.lock()
+            self.shards[os.path.basename(path)[: -len(SHARD_SUFFIX)]] = shard
+
+    # Shards are locked in name order as they are loaded, so processes
+    # selecting overlapping shards can't deadlock
+    def deserialize(self):
+        for path in self.shard_paths():
+            name = os.path.basename(path)[: -len(SHARD_SUFFIX)]
+            if self.selection is not None:
+                # Renames are atomic, so peeking at an unlocked shard is safe.
+                # Only its directory maps are read.
+                peek = syncfile(path)
+                peek.deserialize(dirmaps_only=True)
+                if not any(
+                    dirmap_selected(self.selection, b.bucket_name, d.s3_prefix)
+                    for b in peek.managed_buckets
+                    for d in b.directory_maps
+                ):
+                    continue
+            shard = syncfile(path)
+            shard.lock(self.shared)
+            shard.deserialize()
+            self.shards[name] = shard
+        logger.debug(f"Loaded {len(self.shards)} shards from {self.file_path}")
+
+    def serialize(self):
+        os.makedirs(self.file_path, exist_ok=True)
+        with open(os.path.join(self.file_path, SHARD_MODE_FILE), "w") as f:
+            f.write(self.shard_mode + "\n")
+        for name, shard in self.shards.items():
+            if not any(b.directory_maps for b in shard.managed_buckets):
+                logger.debug(f"Removing empty shard {name}")
+                if shard.file_exists():
+                    os.remove(shard.file_path)
+                if os.path.exists(shard.uploads_path):
+                    os.remove(shard.uploads_path)
+                continue
+            shard.serialize()
@@ -0,0 +1,704 @@
+# s3-bsync Copyright (c) 2022 Joshua Stockin
+# <https://joshstock.in>
+# <https://git.joshstock.in/s3-bsync>
+#
+# This software is licensed and distributed under the terms of the MIT License.
+# See the MIT License in the LICENSE file of this project's root folder.
+#
+# This comment block and its contents, including this disclaimer, MUST be
+# preserved in all copies or distributions of this software's source.
+
+import os
+import mmap
+import zlib
+import base64
+import hashlib
+import logging
+import resource
+import itertools
+import threading
+import contextlib
+import concurrent.futures
+
+from .classes import *
+from . import s3api
+from . import filescan
+from . import concurrency
+from . import dedup
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "upload",
+    "download",
+    "delete_local",
+    "delete_remote",
+    "abort_upload",
+    "upload_batch",
+    "download_batch",
+    "file_view",
+    "view_reader",
+    "report",
+]
+
+
+CHUNK_SIZE = 1024 * 1024
+
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+PART_SIZE = 16 * 1024 * 1024
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+COPY_LIMIT = 5 * 1024**3  # largest object CopyObject can copy in one request
+
+# Files smaller than this are read into a per-thread buffer; larger files are
+# mapped instead
+MMAP_THRESHOLD = 1024 * 1024
+
+GZIP_WBITS = 31  # zlib window bits selecting a gzip header and trailer
+
+# Files smaller than this are transferred in batches: one worker sends a
+# batch's requests back to back over a pooled connection while a separate pool
+# of I/O threads reads (or writes) the files around them
+SMALL_FILE_SIZE = 64 * 1024
+BATCH_FILES = 64
+BATCH_BYTES = 1024 * 1024
+IO_THREADS = 16
+
+STATS = {
+    "files": 0,
+    "bytes_read": 0,
+    "bytes_hashed": 0,
+    "parts": 0,
+    "bytes_resumed": 0,
+    "bytes_copied": 0,
+    "dedup_hits": 0,
+    "bytes_deduplicated": 0,
+    "batches": 0,
+    "batched_files": 0,
+}
+stats_lock = threading.Lock()
+buffers = threading.local()
+io_pool = concurrent.futures.ThreadPoolExecutor(IO_THREADS, thread_name_prefix="io")
+
+
+def count(**counts):
+    with stats_lock:
+        for name, n in counts.items():
+            STATS[name] += n
+
+
+def part_size(size):
+    # Parts must be page aligned to be released with madvise, and S3 allows at
+    # most MAX_PARTS of them
+    size = max(PART_SIZE, -(-size // MAX_PARTS))
+    return -(-size // mmap.PAGESIZE) * mmap.PAGESIZE
+
+
+def multipart_etag(digests):
+    return hashlib.md5(b"".join(digests)).hexdigest() + f"-{len(digests)}"
+
+
+def content_md5(digest):
+    return base64.b64encode(digest).decode()
+
+
+def release(mapping, offset, length):
+    # Drop pages already sent so resident memory stays at about one part
+    if mapping is not None and hasattr(mmap, "MADV_DONTNEED"):
+        mapping.madvise(mmap.MADV_DONTNEED, offset, length)
+
+
+# Yields a read-only memoryview of the whole file, the mapping behind it (None
+# when the file was small enough to read into a reused buffer) and its stat
+@contextlib.contextmanager
+def file_view(path):
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        if size < MMAP_THRESHOLD:
+            buffer = getattr(buffers, "buffer", None)
+            if buffer is None:
+                buffer = buffers.buffer = bytearray(MMAP_THRESHOLD)
+            view = memoryview(buffer)[:size]
+            length = f.readinto(view)
+            count(files=1, bytes_read=length)
+            try:
+                yield view[:length].toreadonly(), None, st
+            finally:
+                view.release()
+            return
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, "MADV_SEQUENTIAL"):
+        mapping.madvise(mmap.MADV_SEQUENTIAL)
+    view = memoryview(mapping)
+    count(files=1, bytes_read=size)
+    try:
+        yield view, mapping, st
+    finally:
+        view.release()
+        try:
+            mapping.close()
+        except BufferError:
+            # A slice is still referenced (e.g. by a traceback); the mapping
+            # is closed when it is collected
+            logger.debug(f"Deferring unmap of {path}")
+
+
+# File-like HTTP body over a memoryview; read() hands out slices of the view
+# rather than copies
+class view_reader:
+    def __init__(self, view):
+        self.view = view
+        self.position = 0
+
+    def read(self, n=-1):
+        start = self.position
+        if n is None or n < 0:
+            self.position = len(self.view)
+        else:
+            self.position = min(len(self.view), start + n)
+        return self.view[start : self.position]
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += len(self.view)
+        self.position = max(0, min(len(self.view), offset))
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def __len__(self):
+        return len(self.view)
+
+
+def hash_view(view):
+    count(bytes_hashed=len(view))
+    return hashlib.md5(view).digest()
+
+
+def compressed_parts(view, mapping, level, size):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    part = bytearray()
+    for offset in range(0, len(view), CHUNK_SIZE):
+        part += compressor.compress(view[offset : offset + CHUNK_SIZE])
+        release(mapping, offset, CHUNK_SIZE)
+        if len(part) >= size:
+            yield memoryview(part)[:size]
+            part = part[size:]
+    part += compressor.flush()
+    while len(part) > size:
+        yield memoryview(part)[:size]
+        part = part[size:]
+    yield memoryview(part)
+
+
+def plain_parts(view, mapping, size):
+    for offset in range(0, max(len(view), 1), size):
+        yield view[offset : offset + size]
+        release(mapping, offset, size)
+
+
+def save_uploads(bucket: sync_managed_bucket):
+    if bucket.save_uploads is not None:
+        bucket.save_uploads()
+
+
+def abort_upload(bucket: sync_managed_bucket, key):
+    upload = bucket.remove_upload(key)
+    if upload is None:
+        return
+    logger.debug(
+        f"Aborting upload {upload.upload_id} of s3://{bucket.bucket_name}/{key}"
+    )
+    try:
+        s3api.abort_multipart_upload(bucket.bucket_name, key, upload.upload_id)
+    except s3api.ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchUpload"):
+            raise
+    save_uploads(bucket)
+
+
+def resume_upload(bucket: sync_managed_bucket, key, fingerprint):
+    upload = bucket.uploads.get(key)
+    if upload is None:
+        return None
+    if (
+        upload.size,
+        upload.modified,
+        upload.inode,
+        upload.part_size,
+        upload.compressed,
+    ) != fingerprint:
+        logger.debug(f"{key} changed since its upload began")
+        abort_upload(bucket, key)
+        return None
+    # The bucket's list of parts is authoritative; the state may have missed
+    # a part that finished as the previous run was interrupted
+    parts = s3api.list_parts(bucket.bucket_name, key, upload.upload_id)
+    if parts is None:
+        logger.debug(f"Upload {upload.upload_id} of {key} no longer exists")
+        bucket.remove_upload(key)
+        save_uploads(bucket)
+        return None
+    upload.parts = parts
+    logger.debug(
+        f"Resuming upload of s3://{bucket.bucket_name}/{key} ({len(parts)} parts uploaded)"
+    )
+    return upload
+
+
+# Multipart uploads are recorded in the state as they progress and are left
+# in place on failure; a later attempt on the unchanged file resends only the
+# parts the bucket doesn't already have. Parts whose digest matches the same
+# part of the previous version (given its tracked record) are copied from the
+# existing object instead of being uploaded.
+def upload_multipart(
+    bucket: sync_managed_bucket,
+    key,
+    st,
+    parts,
+    size,
+    content_encoding=None,
+    previous: sync_fileobject = None,
+    digests=None,
+):
+    fingerprint = (
+        st.st_size,
+        st.st_mtime_ns // 1000000,
+        st.st_ino,
+        size,
+        content_encoding is not None,
+    )
+    upload = resume_upload(bucket, key, fingerprint)
+    if upload is None:
+        upload_id = s3api.create_multipart_upload(
+            bucket.bucket_name, key, content_encoding
+        )
+        upload = bucket.create_upload(key, upload_id, *fingerprint)
+        save_uploads(bucket)
+
+    reusable = []
+    if previous is not None and previous.part_size == size:
+        reusable = previous.part_digests
+
+    # Digests already computed (for the dedup lookup) aren't hashed again;
+    # parts that are resumed or copied then aren't read at all
+    known = digests or []
+    digests = []
+    offset = 0
+    for number, part in enumerate(parts, 1):
+        if number <= len(known):
+            digest = known[number - 1]
+        else:
+            digest = hash_view(part)
+        digests.append(digest)
+        first = offset
+        offset += len(part)
+        if upload.parts.get(number) == digest.hex():
+            count(bytes_resumed=len(part))
+            continue
+        etag = None
+        if number <= len(reusable) and reusable[number - 1] == digest.hex():
+            try:
+                etag = s3api.upload_part_copy(
+                    bucket.bucket_name,
+                    key,
+                    upload.upload_id,
+                    number,
+                    bucket.bucket_name,
+                    key,
+                    first,
+                    offset - 1,
+                    previous.etag,
+                )
+                count(bytes_copied=len(part))
+            except s3api.ClientError as e:
+                if e.response["Error"]["Code"] not in (
+                    "404",
+                    "NoSuchKey",
+                    "412",
+                    "PreconditionFailed",
+                ):
+                    raise
+                # Changed or deleted since it was tracked; send the parts instead
+                logger.debug(f"s3://{bucket.bucket_name}/{key} changed since tracked")
+                reusable = []
+        if etag is None:
+            etag = s3api.upload_part(
+                bucket.bucket_name,
+                key,
+                upload.upload_id,
+                number,
+                view_reader(part),
+                content_md5(digest),
+            )
+            count(parts=1)
+        # Replaced rather than updated so the state can be saved from another
+        # thread while this one is uploading
+        upload.parts = {**upload.parts, number: etag}
+        save_uploads(bucket)
+
+    etag = s3api.complete_multipart_upload(
+        bucket.bucket_name,
+        key,
+        upload.upload_id,
+        [(number, upload.parts[number]) for number in range(1, len(digests) + 1)],
+    )
+    bucket.remove_upload(key)
+    save_uploads(bucket)
+    if etag != multipart_etag(digests):
+        logger.debug(f"ETag of s3://{bucket.bucket_name}/{key} is not an MD5 digest")
+    return etag, digests
+
+
+def copy_multipart(bucket_name, key, source_bucket, source_key, source_etag, size):
+    upload_id = s3api.create_multipart_upload(bucket_name, key)
+    parts = []
+    try:
+        step = part_size(size)
+        for number, first in enumerate(range(0, size, step), 1):
+            etag = s3api.upload_part_copy(
+                bucket_name,
+                key,
+                upload_id,
+                number,
+                source_bucket,
+                source_key,
+                first,
+                min(first + step, size) - 1,
+                source_etag,
+            )
+            parts.append((number, etag))
+        return s3api.complete_multipart_upload(bucket_name, key, upload_id, parts)
+    except BaseException:
+        s3api.abort_multipart_upload(bucket_name, key, upload_id)
+        raise
+
+
+# Materializes the key with a server-side copy of an identical object found in
+# the content index, returning its record, or None if there is none
+def copy_identical(bucket: sync_managed_bucket, key, st, etag):
+    source = dedup.index.lookup(st.st_size, etag, bucket.bucket_name, key)
+    if source is None:
+        return None
+    source_bucket, source_key, source_part_size, source_digests = source
+    logger.debug(
+        f"Copying s3://{source_bucket}/{source_key} to s3://{bucket.bucket_name}/{key}"
+    )
+    try:
+        if st.st_size > COPY_LIMIT:
+            new_etag = copy_multipart(
+                bucket.bucket_name, key, source_bucket, source_key, etag, st.st_size
+            )
+        else:
+            new_etag = s3api.copy_object(
+                bucket.bucket_name, key, source_bucket, source_key, etag
+            )
+    except s3api.ClientError as e:
+        if e.response["Error"]["Code"] not in (
+            "404",
+            "NoSuchKey",
+            "412",
+            "PreconditionFailed",
+        ):
+            raise
+        # The source was changed or deleted since it was tracked
+        logger.debug(f"s3://{source_bucket}/{source_key} no longer matches")
+        dedup.index.discard(st.st_size, etag)
+        return None
+    abort_upload(bucket, key)
+    count(dedup_hits=1, bytes_deduplicated=st.st_size)
+    # The copy holds the same bytes, so the source's part digests still apply
+    record = (key, new_etag, st.st_size, st.st_mtime_ns // 1000000)
+    if source_digests:
+        record += (source_part_size, source_digests)
+    dedup.index.add(bucket.bucket_name, key, new_etag, st.st_size, *record[4:])
+    return record
+
+
+# Each transfer returns the (key, etag, size, mtime) record to track, or None
+# when the key should no longer be tracked. Uncompressed multipart uploads add
+# the part size and part digests.
+
+
+def upload(bucket: sync_managed_bucket, dirmap: sync_directory_map, key):
+    bucket_name = bucket.bucket_name
+    path = filescan.path_from_key(dirmap, key)
+    logger.debug(f"Uploading {path} to s3://{bucket_name}/{key}")
+    # The mapped file is hashed and sent from the same memory; nothing is read
+    # into intermediate buffers
+    with file_view(path) as (view, mapping, st):
+        size = part_size(len(view))
+        if dirmap.gz_compress > 0:
+            parts = compressed_parts(view, mapping, dirmap.gz_compress, size)
+            first = next(parts)
+            second = next(parts, None)
+            if second is not None:
+                etag, _ = upload_multipart(
+                    bucket,
+                    key,
+                    st,
+                    itertools.chain([first, second], parts),
+                    size,
+                    "gzip",
+                )
+            else:
+                abort_upload(bucket, key)
+                etag = s3api.put_object(
+                    bucket_name,
+                    key,
+                    view_reader(first),
+                    content_md5(hash_view(first)),
+                    "gzip",
+                )
+        elif len(view) >= MULTIPART_THRESHOLD:
+            digests = None
+            if dedup.index.has_size(len(view)):
+                digests = [hash_view(part) for part in plain_parts(view, mapping, size)]
+                record = copy_identical(bucket, key, st, multipart_etag(digests))
+                if record is not None:
+                    return record
+            etag, digests = upload_multipart(
+                bucket,
+                key,
+                st,
+                plain_parts(view, mapping, size),
+                size,
+                previous=bucket.fileobjects.get(key),
+                digests=digests,
+            )
+            digests = [digest.hex() for digest in digests]
+            dedup.index.add(bucket_name, key, etag, st.st_size, size, digests)
+            return (key, etag, st.st_size, st.st_mtime_ns // 1000000, size, digests)
+        else:
+            digest = hash_view(view)
+            if dedup.index.has_size(len(view)):
+                record = copy_identical(bucket, key, st, digest.hex())
+                if record is not None:
+                    return record
+            abort_upload(bucket, key)
+            etag = s3api.put_object(
+                bucket_name, key, view_reader(view), content_md5(digest)
+            )
+            dedup.index.add(bucket_name, key, etag, st.st_size)
+    return (key, etag, st.st_size, st.st_mtime_ns // 1000000)
+
+
+def download(bucket: sync_managed_bucket, dirmap: sync_directory_map, key):
+    bucket_name = bucket.bucket_name
+    path = filescan.path_from_key(dirmap, key)
+    temp_path = path + filescan.TEMP_SUFFIX
+    logger.debug(f"Downloading s3://{bucket_name}/{key} to {path}")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    etag, body, encoding, _ = s3api.get_object(bucket_name, key)
+    decompressor = None
+    if encoding == "gzip":
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+    try:
+        with open(temp_path, "wb") as f:
+            for chunk in body.iter_chunks(CHUNK_SIZE):
+                f.write(decompressor.decompress(chunk) if decompressor else chunk)
+            if decompressor:
+                f.write(decompressor.flush())
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    st = os.stat(path)
+    return (key, etag, st.st_size, st.st_mtime_ns // 1000000)
+
+
+def delete_local(bucket: sync_managed_bucket, dirmap: sync_directory_map, key):
+    path = filescan.path_from_key(dirmap, key)
+    logger.debug(f"Deleting {path}")
+    if os.path.exists(path):
+        os.remove(path)
+    return None
+
+
+def delete_remote(bucket: sync_managed_bucket, dirmap: sync_directory_map, key):
+    logger.debug(f"Deleting s3://{bucket.bucket_name}/{key}")
+    s3api.delete_object(bucket.bucket_name, key)
+    return None
+
+
+# Small file batches. Each request still takes a slot in the adaptive
+# concurrency windows, so throttling is retried per request rather than by
+# resending the whole batch. Each takes the batch's sync_actions and returns a
+# list of (key, record or exception).
+
+
+def read_small(dirmap: sync_directory_map, key):
+    path = filescan.path_from_key(dirmap, key)
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        data = f.read(SMALL_FILE_SIZE)
+        if f.read(1):
+            # Grew past the batch threshold since it was scanned
+            return None, st
+    count(files=1, bytes_read=len(data))
+    if dirmap.gz_compress > 0:
+        compressor = zlib.compressobj(dirmap.gz_compress, zlib.DEFLATED, GZIP_WBITS)
+        data = compressor.compress(data) + compressor.flush()
+    return data, st
+
+
+# Builds the body inside the retried call; a retry after a throttled request
+# needs a reader positioned at the start again
+def put_small(bucket_name, key, view, digest, encoding):
+    return s3api.put_object(
+        bucket_name, key, view_reader(view), content_md5(digest), encoding
+    )
+
+
+def upload_batch(bucket: sync_managed_bucket, dirmap: sync_directory_map, actions):
+    bucket_name = bucket.bucket_name
+    keys = [action.key for action in actions]
+    encoding = "gzip" if dirmap.gz_compress > 0 else None
+    logger.debug(f"Uploading batch of {len(keys)} files to s3://{bucket_name}")
+    # Reads are queued up front so the files are in memory by the time their
+    # turn comes to be sent
+    reads = [io_pool.submit(read_small, dirmap, key) for key in keys]
+    results = []
+    for key, read in zip(keys, reads):
+        prefix = filescan.key_prefix(dirmap, key)
+        try:
+            data, st = read.result()
+            if data is None:
+                results.append(
+                    (
+                        key,
+                        concurrency.limiter.call(
+                            bucket_name,
+                            prefix,
+                            st.st_size,
+                            s3api.is_retriable,
+                            upload,
+                            bucket,
+                            dirmap,
+                            key,
+                        ),
+                    )
+                )
+                continue
+            view = memoryview(data)
+            digest = hash_view(view)
+            abort_upload(bucket, key)
+            etag = concurrency.limiter.call(
+                bucket_name,
+                prefix,
+                len(data),
+                s3api.is_retriable,
+                put_small,
+                bucket_name,
+                key,
+                view,
+                digest,
+                encoding,
+            )
+        except (OSError, s3api.ClientError, s3api.BotoCoreError) as e:
+            results.append((key, e))
+            continue
+        results.append((key, (key, etag, st.st_size, st.st_mtime_ns // 1000000)))
+    count(batches=1, batched_files=len(keys))
+    return results
+
+
+def write_small(dirmap: sync_directory_map, key, data, encoding):
+    path = filescan.path_from_key(dirmap, key)
+    temp_path = path + filescan.TEMP_SUFFIX
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if encoding == "gzip":
+        data = zlib.decompress(data, GZIP_WBITS)
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return os.stat(path)
+
+
+def get_small(bucket_name, key):
+    etag, body, encoding, length = s3api.get_object(bucket_name, key)
+    if length >= SMALL_FILE_SIZE:
+        # Grew past the batch threshold since it was listed
+        body.close()
+        return None
+    return etag, body.read(), encoding
+
+
+def download_batch(bucket: sync_managed_bucket, dirmap: sync_directory_map, actions):
+    bucket_name = bucket.bucket_name
+    logger.debug(f"Downloading batch of {len(actions)} files from s3://{bucket_name}")
+    writes = []
+    results = []
+    for action in actions:
+        key = action.key
+        prefix = filescan.key_prefix(dirmap, key)
+        try:
+            response = concurrency.limiter.call(
+                bucket_name,
+                prefix,
+                action.size,
+                s3api.is_retriable,
+                get_small,
+                bucket_name,
+                key,
+            )
+            if response is None:
+                results.append(
+                    (
+                        key,
+                        concurrency.limiter.call(
+                            bucket_name,
+                            prefix,
+                            action.size,
+                            s3api.is_retriable,
+                            download,
+                            bucket,
+                            dirmap,
+                            key,
+                        ),
+                    )
+                )
+                continue
+        except (OSError, s3api.ClientError, s3api.BotoCoreError) as e:
+            results.append((key, e))
+            continue
+        etag, data, encoding = response
+        # The next request goes out while this file is written
+        writes.append(
+            (key, etag, io_pool.submit(write_small, dirmap, key, data, encoding))
+        )
+    for key, etag, write in writes:
+        try:
+            st = write.result()
+        except (OSError, zlib.error) as e:
+            results.append((key, e))
+            continue
+        results.append((key, (key, etag, st.st_size, st.st_mtime_ns // 1000000)))
+    count(batches=1, batched_files=len(actions))
+    return results
+
+
+def report():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime
+    gib = STATS["bytes_read"] / 1024**3
+    lines = [
+        f'  Files read: {STATS["files"]} ({concurrency.format_bytes(STATS["bytes_read"])}, {STATS["parts"]} multipart parts)',
+        f'  Hashed:     {concurrency.format_bytes(STATS["bytes_hashed"])}',
+        f'  Resumed:    {concurrency.format_bytes(STATS["bytes_resumed"])} already uploaded by an earlier run',
+        f'  Copied:     {concurrency.format_bytes(STATS["bytes_copied"])} of unchanged parts reused from previous versions',
+        f'  Batched:    {STATS["batched_files"]} small files in {STATS["batches"]} batches',
+        f'  Dedup:      {STATS["dedup_hits"]} files ({concurrency.format_bytes(STATS["bytes_deduplicated"])}) copied from identical objects instead of uploaded',
+        f"  CPU time:   {cpu:.2f}s" + (f" ({cpu / gib:.2f}s/GiB)" if gib else ""),
+        # ru_maxrss is in kilobytes on Linux
+        f"  Peak RSS:   {concurrency.format_bytes(usage.ru_maxrss * 1024)}",
+    ]
+    return lines
@@ -0,0 +1,315 @@
+# s3-bsync Copyright (c) 2022 Joshua Stockin
+# <https://joshstock.in>
+# <https://git.joshstock.in/s3-bsync>
+#
+# This software is licensed and distributed under the terms of the MIT License.
+# See the MIT License in the LICENSE file of this project's root folder.
+#
+# This comment block and its contents, including this disclaimer, MUST be
+# preserved in all copies or distributions of this software's source.
+
+import os
+import time
+import select
+import signal
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+from .classes import *
+from . import s3api
+from . import sync
+from . import syncfile
+from . import concurrency
+from . import transfer
+from . import filescan
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["inotify", "watch"]
+
+
+INOTIFY_FLAGS = {
+    "IN_MODIFY": 0x00000002,
+    "IN_ATTRIB": 0x00000004,
+    "IN_CLOSE_WRITE": 0x00000008,
+    "IN_MOVED_FROM": 0x00000040,
+    "IN_MOVED_TO": 0x00000080,
+    "IN_CREATE": 0x00000100,
+    "IN_DELETE": 0x00000200,
+    "IN_DELETE_SELF": 0x00000400,
+    "IN_MOVE_SELF": 0x00000800,
+    "IN_Q_OVERFLOW": 0x00004000,
+    "IN_IGNORED": 0x00008000,
+    "IN_ONLYDIR": 0x01000000,
+    "IN_ISDIR": 0x40000000,
+    "IN_NONBLOCK": 0o4000,
+    "IN_CLOEXEC": 0o2000000,
+}
+
+WATCH_MASK = (
+    INOTIFY_FLAGS["IN_MODIFY"]
+    | INOTIFY_FLAGS["IN_ATTRIB"]
+    | INOTIFY_FLAGS["IN_CLOSE_WRITE"]
+    | INOTIFY_FLAGS["IN_MOVED_FROM"]
+    | INOTIFY_FLAGS["IN_MOVED_TO"]
+    | INOTIFY_FLAGS["IN_CREATE"]
+    | INOTIFY_FLAGS["IN_DELETE"]
+    | INOTIFY_FLAGS["IN_DELETE_SELF"]
+    | INOTIFY_FLAGS["IN_MOVE_SELF"]
+    | INOTIFY_FLAGS["IN_ONLYDIR"]
+)
+
+EVENT_HEADER = struct.Struct("iIII")
+
+DEBOUNCE_INTERVAL = 2.0  # seconds a key must be quiet before it is synced
+BATCH_SIZE = 64  # keys synced per batch
+RELIST_INTERVAL = 300.0  # seconds between remote listings
+CHECKPOINT_INTERVAL = 60.0  # seconds between state file writes
+
+
+class inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(
+            INOTIFY_FLAGS["IN_NONBLOCK"] | INOTIFY_FLAGS["IN_CLOEXEC"]
+        )
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed", path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = buffer[offset : offset + length].rstrip(b"\x00")
+            offset += length
+            yield wd, mask, os.fsdecode(name)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class watcher:
+    def __init__(self, state, dryrun=False, selection=None, stats=False):
+        self.state = state
+        self.dryrun = dryrun
+        self.selection = selection
+        self.stats = stats
+        self.inotify = inotify()
+        self.watches = {}  # wd -> (bucket, dirmap, directory path)
+        self.dirty = {}  # (bucket index, dirmap index) -> {key: last event time}
+        self.running = True
+
+    def add_directory(self, bucket_index, dirmap_index, path, scan=True):
+        bucket = self.state.managed_buckets[bucket_index]
+        dirmap = bucket.directory_maps[dirmap_index]
+        try:
+            wd = self.inotify.add_watch(path)
+        except OSError as e:
+            logger.error(f"Unable to watch {path}: {e}")
+            return
+        self.watches[wd] = (bucket_index, dirmap_index, path)
+        logger.debug(f"Watching {path}")
+
+        # Files created before the watch was added would otherwise be missed.
+        # At startup they're covered by a full sync instead (scan False).
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if dirmap.recursive:
+                        self.add_directory(bucket_index, dirmap_index, entry.path, scan)
+                elif scan and entry.is_file(follow_symlinks=False):
+                    self.mark(bucket_index, dirmap_index, entry.path)
+
+    def remove_directory(self, wd):
+        bucket_index, dirmap_index, path = self.watches.pop(wd)
+        bucket = self.state.managed_buckets[bucket_index]
+        dirmap = bucket.directory_maps[dirmap_index]
+        prefix = filescan.key_from_path(dirmap, path) + "/"
+        for key in bucket.fileobjects:
+            if key.startswith(prefix):
+                self.mark_key(bucket_index, dirmap_index, key)
+        for other in [
+            w for w, (_, _, p) in self.watches.items() if p.startswith(path + os.sep)
+        ]:
+            self.inotify.rm_watch(other)
+            del self.watches[other]
+
+    def mark(self, bucket_index, dirmap_index, path):
+        dirmap = self.state.managed_buckets[bucket_index].directory_maps[dirmap_index]
+        self.mark_key(bucket_index, dirmap_index, filescan.key_from_path(dirmap, path))
+
+    def mark_key(self, bucket_index, dirmap_index, key):
+        dirmap = self.state.managed_buckets[bucket_index].directory_maps[dirmap_index]
+        if filescan.key_in_dirmap(dirmap, key):
+            keys = self.dirty.setdefault((bucket_index, dirmap_index), {})
+            keys[key] = time.monotonic()
+
+    def dirmaps(self):
+        for bucket_index, bucket in enumerate(self.state.managed_buckets):
+            for dirmap_index, dirmap in enumerate(bucket.directory_maps):
+                if syncfile.dirmap_selected(
+                    self.selection, bucket.bucket_name, dirmap.s3_prefix
+                ):
+                    yield bucket_index, dirmap_index, bucket, dirmap
+
+    # Watches are added before the full sync so changes made during it are
+    # picked up afterwards
+    def start(self):
+        for bucket_index, dirmap_index, bucket, dirmap in self.dirmaps():
+            self.add_directory(bucket_index, dirmap_index, dirmap.local_path, False)
+        for bucket_index, dirmap_index, bucket, dirmap in self.dirmaps():
+            try:
+                sync.sync_dirmap(bucket, dirmap, self.dryrun)
+            except (s3api.ClientError, s3api.BotoCoreError) as e:
+                logger.error(
+                    f"Unable to sync s3://{bucket.bucket_name}/{dirmap.s3_prefix}/: {e}"
+                )
+
+    def rescan(self):
+        logger.debug("Event queue overflowed. Rescanning all directory maps")
+        for wd in list(self.watches):
+            self.inotify.rm_watch(wd)
+        self.watches.clear()
+        self.start()
+
+    def handle_event(self, wd, mask, name):
+        if mask & INOTIFY_FLAGS["IN_Q_OVERFLOW"]:
+            self.rescan()
+            return
+        if wd not in self.watches:
+            return
+        if mask & INOTIFY_FLAGS["IN_IGNORED"] or mask & (
+            INOTIFY_FLAGS["IN_DELETE_SELF"] | INOTIFY_FLAGS["IN_MOVE_SELF"]
+        ):
+            self.remove_directory(wd)
+            return
+
+        bucket_index, dirmap_index, directory = self.watches[wd]
+        dirmap = self.state.managed_buckets[bucket_index].directory_maps[dirmap_index]
+        path = os.path.join(directory, name)
+
+        if mask & INOTIFY_FLAGS["IN_ISDIR"]:
+            if mask & (INOTIFY_FLAGS["IN_CREATE"] | INOTIFY_FLAGS["IN_MOVED_TO"]):
+                if dirmap.recursive:
+                    self.add_directory(bucket_index, dirmap_index, path)
+            elif mask & INOTIFY_FLAGS["IN_MOVED_FROM"]:
+                moved = [w for w, (_, _, p) in self.watches.items() if p == path]
+                for w in moved:
+                    self.inotify.rm_watch(w)
+                    self.remove_directory(w)
+            return
+
+        if name.endswith(filescan.TEMP_SUFFIX):
+            return
+        self.mark(bucket_index, dirmap_index, path)
+
+    def relist(self):
+        logger.debug("Relisting remote directory maps")
+        for bucket_index, dirmap_index, bucket, dirmap in self.dirmaps():
+            # Keys changed or removed remotely are synced against the listing
+            # itself rather than a HEAD per key
+            remote_keys = set()
+            changed = {}
+            try:
+                for entry in filescan.remote_scan(bucket.bucket_name, dirmap):
+                    remote_keys.add(entry[0])
+                    fileobject = bucket.fileobjects.get(entry[0])
+                    if not fileobject or fileobject.etag != entry[1]:
+                        changed[entry[0]] = entry
+                keys = list(changed)
+                for entry in filescan.tracked_scan(bucket, dirmap):
+                    if entry[0] not in remote_keys:
+                        keys.append(entry[0])
+                if keys:
+                    sync.sync_keys(bucket, dirmap, keys, changed, self.dryrun)
+            except (s3api.ClientError, s3api.BotoCoreError) as e:
+                logger.error(
+                    f"Unable to relist s3://{bucket.bucket_name}/{dirmap.s3_prefix}/: {e}"
+                )
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        for (bucket_index, dirmap_index), keys in self.dirty.items():
+            ready = [
+                k for k, t in keys.items() if force or now - t >= DEBOUNCE_INTERVAL
+            ]
+            if not ready:
+                continue
+            bucket = self.state.managed_buckets[bucket_index]
+            dirmap = bucket.directory_maps[dirmap_index]
+            for i in range(0, len(ready), BATCH_SIZE):
+                batch = ready[i : i + BATCH_SIZE]
+                for key in batch:
+                    del keys[key]
+                logger.debug(
+                    f"Syncing {len(batch)} dirty keys in s3://{bucket.bucket_name}"
+                )
+                try:
+                    sync.sync_keys(bucket, dirmap, batch, dryrun=self.dryrun)
+                except (s3api.ClientError, s3api.BotoCoreError) as e:
+                    # Retried once the keys have been quiet for another interval
+                    logger.error(
+                        f"Unable to sync keys in s3://{bucket.bucket_name}: {e}"
+                    )
+                    for key in ready[i:]:
+                        keys.setdefault(key, now)
+                    break
+
+    def stop(self, signum=None, frame=None):
+        logger.debug("Stopping watch daemon")
+        self.running = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        self.start()
+        last_relist = time.monotonic()
+        last_checkpoint = time.monotonic()
+
+        while self.running:
+            for wd, mask, name in self.inotify.read_events(DEBOUNCE_INTERVAL / 2):
+                self.handle_event(wd, mask, name)
+            self.flush()
+
+            now = time.monotonic()
+            if now - last_relist >= RELIST_INTERVAL:
+                self.relist()
+                last_relist = now
+            if now - last_checkpoint >= CHECKPOINT_INTERVAL:
+                if not self.dryrun:
+                    logger.debug("Checkpointing state file")
+                    self.state.serialize()
+                if self.stats:
+                    logger.info(
+                        "Transfer stats\n"
+                        + "\n".join(concurrency.report() + transfer.report())
+                    )
+                last_checkpoint = now
+
+        self.flush(force=True)
+        self.inotify.close()
+
+
+def watch(state, dryrun=False, selection=None, stats=False):
+    logger.debug("Entering watch mode")
+    watcher(state, dryrun, selection, stats).run()
@@ -0,0 +1,160 @@
+# s3-bsync Copyright (c) 2022 Joshua Stockin
+# <https://joshstock.in>
+# <https://git.joshstock.in/s3-bsync>
+#
+# This software is licensed and distributed under the terms of the MIT License.
+# See the MIT License in the LICENSE file of this project's root folder.
+#
+# This comment block and its contents, including this disclaimer, MUST be
+# preserved in all copies or distributions of this software's source.
+
+import threading
+import concurrent.futures
+
+import pytest
+
+from src import s3api
+from src import concurrency
+
+
+class clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+def client_error(code):
+    return s3api.ClientError({"Error": {"Code": code}}, "PutObject")
+
+
+# Stand-in for S3 that throttles whenever more than `capacity` requests are in
+# flight at once
+class backend:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.in_flight = 0
+        self.calls = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def request(self, n):
+        with self.lock:
+            self.calls += 1
+            self.in_flight += 1
+            throttle = self.in_flight > self.capacity
+            if throttle:
+                self.throttled += 1
+        try:
+            if throttle:
+                raise client_error("SlowDown")
+            threading.Event().wait(0.002)
+            return n
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+@pytest.fixture
+def fake_clock(monkeypatch):
+    fake = clock()
+    monkeypatch.setattr(concurrency, "time", fake)
+    return fake
+
+
+def test_throttling_halves_window_once_per_interval(fake_clock):
+    window = concurrency.aimd_window("bucket", initial=16)
+    for _ in range(4):
+        window.acquire()
+    for _ in range(4):
+        window.release(throttled=True, completed=False)
+    assert window.window == 8
+    assert window.throttles == 4
+
+    fake_clock.now += concurrency.SAMPLE_INTERVAL
+    window.acquire()
+    window.release(throttled=True, completed=False)
+    assert window.window == 4
+
+    for _ in range(10):
+        fake_clock.now += concurrency.SAMPLE_INTERVAL
+        window.acquire()
+        window.release(throttled=True, completed=False)
+    assert window.window == concurrency.MIN_WINDOW
+
+
+def test_window_grows_only_when_saturated_and_rising(fake_clock):
+    window = concurrency.aimd_window("bucket", initial=2)
+
+    # Completions one at a time never fill the window
+    for _ in range(3):
+        window.acquire()
+        fake_clock.now += concurrency.SAMPLE_INTERVAL
+        window.release(nbytes=1)
+    assert window.window == 2
+
+    # Filling the window lets more requests complete per sample each time
+    for _ in range(3):
+        slots = int(window.window)
+        for _ in range(slots):
+            window.acquire()
+        for _ in range(slots - 1):
+            window.release(nbytes=10)
+        fake_clock.now += concurrency.SAMPLE_INTERVAL
+        window.release(nbytes=10)
+    assert window.window == 5
+
+
+def test_limiter_converges_under_throttling(monkeypatch):
+    monkeypatch.setattr(concurrency, "BACKOFF_BASE", 0.001)
+    limiter = concurrency.adaptive_limiter()
+    server = backend(capacity=2)
+
+    def call(n):
+        return limiter.call(
+            "bucket", "prefix", 1, s3api.is_retriable, server.request, n
+        )
+
+    with concurrent.futures.ThreadPoolExecutor(16) as executor:
+        results = list(executor.map(call, range(200)))
+
+    assert results == list(range(200))
+    assert server.throttled > 0
+    assert limiter.retries == server.throttled
+    assert server.calls == 200 + server.throttled
+    windows = {w["name"]: w for w in limiter.stats()}
+    assert windows["bucket"]["window"] <= server.capacity
+    assert windows["bucket"]["throttles"] == server.throttled
+    assert windows["bucket"]["total_requests"] == 200
+    assert windows["bucket"]["in_flight"] == 0
+
+
+def test_limiter_raises_other_errors():
+    limiter = concurrency.adaptive_limiter()
+    calls = []
+
+    def request():
+        calls.append(1)
+        raise client_error("AccessDenied")
+
+    with pytest.raises(s3api.ClientError):
+        limiter.call("bucket", "prefix", 0, s3api.is_retriable, request)
+    assert len(calls) == 1
+    assert limiter.retries == 0
+    assert limiter.window("bucket").in_flight == 0
+
+
+def test_limiter_gives_up_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(concurrency, "BACKOFF_BASE", 0.001)
+    limiter = concurrency.adaptive_limiter()
+    calls = []
+
+    def request():
+        calls.append(1)
+        raise client_error("SlowDown")
+
+    with pytest.raises(s3api.ClientError):
+        limiter.call("bucket", "prefix", 0, s3api.is_retriable, request)
+    assert len(calls) == concurrency.MAX_ATTEMPTS
+    assert limiter.retries == concurrency.MAX_ATTEMPTS - 1
@@ -0,0 +1,155 @@
+# s3-bsync Copyright (c) 2022 Joshua Stockin
+# <https://joshstock.in>
+# <https://git.joshstock.in/s3-bsync>
+#
+# This software is licensed and distributed under the terms of the MIT License.
+# See the MIT License in the LICENSE file of this project's root folder.
+#
+# This comment block and its contents, including this disclaimer, MUST be
+# preserved in all copies or distributions of this software's source.
+
+import csv
+import gzip
+import json
+
+import pytest
+
+from src import filescan
+from src import inventory
+
+SCHEMA = (
+    "Bucket, Key, VersionId, IsLatest, IsDeleteMarker, Size, LastModifiedDate, ETag"
+)
+
+MODIFIED = "2022-03-01T12:00:00.000Z"
+MODIFIED_MILLIS = 1646136000000
+
+
+def row(key, size="1", latest="true", deleted="false", etag="e"):
+    return ["source", key, "v1", latest, deleted, size, MODIFIED, etag]
+
+
+# Writes a CSV inventory laid out like the destination bucket: the manifest
+# under its dated directory and the data files under data/
+def write_report(tmp_path, *files):
+    keys = []
+    for i, rows in enumerate(files):
+        key = f"source/inv/data/{i}.csv.gz"
+        path = tmp_path / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with gzip.open(path, "wt", newline="") as f:
+            csv.writer(f).writerows(rows)
+        keys.append({"key": key})
+    manifest = tmp_path / "source/inv/2022-03-01T00-00Z/manifest.json"
+    manifest.parent.mkdir(parents=True)
+    manifest.write_text(
+        json.dumps(
+            {
+                "sourceBucket": "source",
+                "destinationBucket": "arn:aws:s3:::destination",
+                "creationTimestamp": "1646092800000",
+                "fileFormat": "CSV",
+                "fileSchema": SCHEMA,
+                "files": keys,
+            }
+        )
+    )
+    return inventory.inventory(str(manifest))
+
+
+def test_reads_csv_rows(tmp_path):
+    report = write_report(
+        tmp_path,
+        [
+            row("dir/file+name%21.txt", size="12", etag="abc"),
+            row("dir/old", latest="false"),
+            row("dir/deleted", deleted="true"),
+            row("dir/empty", size=""),
+        ],
+    )
+    assert report.source_bucket == "source"
+    assert report.destination_bucket == "destination"
+    assert list(report.rows()) == [
+        ("dir/file name!.txt", "abc", 12, MODIFIED_MILLIS),
+        ("dir/empty", "e", 0, MODIFIED_MILLIS),
+    ]
+
+
+def test_rejects_unsupported_format(tmp_path):
+    report = write_report(tmp_path, [])
+    manifest = json.loads(open(report.manifest_path).read())
+    manifest["fileFormat"] = "JSON"
+    with open(report.manifest_path, "w") as f:
+        json.dump(manifest, f)
+    with pytest.raises(SystemExit):
+        inventory.inventory(report.manifest_path)
+
+
+def test_rejects_missing_fields(tmp_path):
+    report = write_report(tmp_path, [])
+    manifest = json.loads(open(report.manifest_path).read())
+    manifest["fileSchema"] = "Bucket, Key, Size, LastModifiedDate"
+    with open(report.manifest_path, "w") as f:
+        json.dump(manifest, f)
+    with pytest.raises(SystemExit):
+        inventory.inventory(report.manifest_path)
+
+
+def test_split_sorts_each_prefix(tmp_path):
+    report = write_report(
+        tmp_path,
+        [row("b/2"), row("a/x/2"), row("c/1")],
+        [row("a/x/1"), row("b/1"), row("a/y")],
+    )
+    reads = []
+    rows = report.rows
+    report.rows = lambda: reads.append(1) or rows()
+
+    report.split(["a/", "a/x/", "b/", "d/"])
+    assert len(reads) == 1
+    assert [e[0] for e in report.entries("a/")] == ["a/x/1", "a/x/2", "a/y"]
+    assert [e[0] for e in report.entries("a/x/")] == ["a/x/1", "a/x/2"]
+    assert [e[0] for e in report.entries("b/")] == ["b/1", "b/2"]
+    assert list(report.entries("d/")) == []
+    assert report.last_keys == {"a/": "a/y", "a/x/": "a/x/2", "b/": "b/2", "d/": None}
+    assert len(reads) == 1
+
+
+def test_split_spills_under_memory_cap(tmp_path):
+    keys = [f"a/{i:04d}" for i in range(500)]
+    report = write_report(tmp_path, [row(key) for key in reversed(keys)])
+    report.split(["a/"], max_memory=4096)
+    assert len(report.sorted["a/"].runs) > 1
+    assert [e[0] for e in report.entries("a/")] == keys
+
+
+def test_entries_of_unsplit_prefix(tmp_path):
+    report = write_report(tmp_path, [row("b/1"), row("a/1")])
+    report.split(["a/"])
+    assert [e[0] for e in report.entries("b/")] == ["b/1"]
+    assert [e[0] for e in report.entries("a/")] == ["a/1"]
+
+
+def test_refresh_stale(monkeypatch):
+    heads = []
+
+    def head_object(bucket_name, key):
+        heads.append(key)
+        return (key, "fresh", 1, 1)
+
+    monkeypatch.setattr(filescan.s3api, "head_object", head_object)
+    entry = ("a/1", "old", 1, 1)
+    refresh = filescan.refresh_stale
+
+    # Keys after the end of the report may have been written since it was made
+    assert refresh("b", None, "a/1", entry, None, entry) is None
+    assert refresh("b", "a/0", "a/1", entry, None, entry) is None
+    # Listed as tracked, or absent from the report with no conflict to resolve
+    assert refresh("b", "a/9", "a/1", entry, entry, entry) is entry
+    assert refresh("b", "a/9", "a/1", None, None, None) is None
+    assert heads == []
+    # The report disagrees with the state, or misses an untracked local file
+    assert refresh("b", "a/9", "a/1", entry, ("a/1", "new", 1, 1), entry)[1] == "fresh"
+    assert refresh("b", "a/9", "a/1", entry, None, entry)[1] == "fresh"
+    assert refresh("b", "a/9", "a/1", entry, None, None)[1] == "fresh"
+    assert heads == ["a/1"] * 3
@@ -0,0 +1,182 @@
+# s3-bsync Copyright (c) 2022 Joshua Stockin
+# <https://joshstock.in>
+# <https://git.joshstock.in/s3-bsync>
+#
+# This software is licensed and distributed under the terms of the MIT License.
+# See the MIT License in the LICENSE file of this project's root folder.
+#
+# This comment block and its contents, including this disclaimer, MUST be
+# preserved in all copies or distributions of this software's source.
+
+import os
+
+import pytest
+
+from src import syncfile
+
+MD5 = "0123456789abcdef0123456789abcdef"
+DIGESTS = ["00" * 16, "ff" * 16, "5a" * 16]
+
+
+def local_dir(tmp_path, name):
+    path = tmp_path / name
+    path.mkdir(exist_ok=True)
+    return str(path)
+
+
+def make_state(tmp_path, part_digests=True):
+    state = syncfile.syncfile(str(tmp_path / "state.s3sync"))
+    state.map_directory(local_dir(tmp_path, "docs"), "s3://bucket-one/docs")
+    state.map_directory(local_dir(tmp_path, "pics"), "s3://bucket-one/pics")
+    state.map_directory(local_dir(tmp_path, "docs"), "s3://bucket-two/backup")
+    one, two = state.managed_buckets
+    one.create_fileobject("docs/a.txt", 1646136000000, MD5, 5)
+    one.create_fileobject("pics/ü.jpg", 1646136000001, f"{MD5}-3", 40 << 20)
+    if part_digests:
+        one.fileobjects["pics/ü.jpg"].part_size = 16 << 20
+        one.fileobjects["pics/ü.jpg"].part_digests = list(DIGESTS)
+    two.create_fileobject("backup/empty", 0, "", 0)
+    return state
+
+
+def load(path, **kwargs):
+    state = syncfile.syncfile(path)
+    state.deserialize(**kwargs)
+    return state
+
+
+def dirmaps(state):
+    return [
+        (b.bucket_name, d.local_path, d.s3_prefix, d.gz_compress, d.recursive)
+        for b in state.managed_buckets
+        for d in b.directory_maps
+    ]
+
+
+def fileobjects(state):
+    return {
+        (b.bucket_name, o.key): (
+            o.modified,
+            o.etag,
+            o.size,
+            o.part_size,
+            o.part_digests,
+        )
+        for b in state.managed_buckets
+        for o in b.fileobjects.values()
+    }
+
+
+def uploads(state):
+    return {
+        (b.bucket_name, u.key): (
+            u.upload_id,
+            u.size,
+            u.modified,
+            u.inode,
+            u.part_size,
+            u.compressed,
+            u.parts,
+        )
+        for b in state.managed_buckets
+        for u in b.uploads.values()
+    }
+
+
+def test_round_trip(tmp_path):
+    state = make_state(tmp_path)
+    state.serialize()
+    loaded = load(state.file_path)
+    assert loaded.file_version == syncfile.CURRENT_VERSION
+    assert loaded.last_synced_time > 0
+    assert dirmaps(loaded) == dirmaps(state)
+    assert fileobjects(loaded) == fileobjects(state)
+    assert not os.path.exists(state.uploads_path)
+
+
+def test_reads_version_1(tmp_path):
+    # Version 1 files are version 2 files without part digests
+    state = make_state(tmp_path, part_digests=False)
+    state.serialize()
+    with open(state.file_path, "r+b") as f:
+        f.seek(4)
+        f.write(b"\x01")
+    loaded = load(state.file_path)
+    assert loaded.file_version == 1
+    assert dirmaps(loaded) == dirmaps(state)
+    assert fileobjects(loaded) == fileobjects(state)
+
+
+def test_rejects_newer_version(tmp_path):
+    state = make_state(tmp_path)
+    state.serialize()
+    with open(state.file_path, "r+b") as f:
+        f.seek(4)
+        f.write((syncfile.CURRENT_VERSION + 1).to_bytes(1, "little"))
+    with pytest.raises(SystemExit):
+        load(state.file_path)
+
+
+def test_dirmaps_only(tmp_path):
+    state = make_state(tmp_path)
+    state.serialize()
+    loaded = load(state.file_path, dirmaps_only=True)
+    # Reading stops at the first object, before the second bucket
+    assert dirmaps(loaded) == dirmaps(state)[:2]
+    assert fileobjects(loaded) == {}
+
+
+def test_uploads_round_trip(tmp_path):
+    state = make_state(tmp_path)
+    one, two = state.managed_buckets
+    upload = one.create_upload("pics/big.raw", "id-1", 48 << 20, 1, 1234, 16 << 20)
+    upload.parts = {1: MD5, 2: "not-an-md5"}
+    two.create_upload("backup/big.gz", "id-2", 32 << 20, 2, 5678, 8 << 20, True)
+    state.serialize()
+    assert os.path.exists(state.uploads_path)
+
+    loaded = load(state.file_path)
+    assert uploads(loaded) == uploads(state)
+
+    # Sessions for buckets no longer in the state file are dropped
+    os.replace(state.uploads_path, tmp_path / "uploads")
+    two.directory_maps = []
+    state.serialize()
+    os.replace(tmp_path / "uploads", state.uploads_path)
+    loaded = load(state.file_path)
+    assert list(uploads(loaded)) == [("bucket-one", "pics/big.raw")]
+
+    # The sidecar is removed once no uploads are left
+    for bucket in state.managed_buckets:
+        bucket.uploads.clear()
+    state.save_uploads()
+    assert not os.path.exists(state.uploads_path)
+
+
+def test_unreadable_uploads_ignored(tmp_path):
+    state = make_state(tmp_path)
+    state.serialize()
+    with open(state.uploads_path, "wb") as f:
+        f.write(b"garbage")
+    assert uploads(load(state.file_path)) == {}
+
+
+def test_sharded_selection(tmp_path):
+    state_dir = str(tmp_path / "shards")
+    state = syncfile.sharded_syncfile(state_dir, "dirmap")
+    state.map_directory(local_dir(tmp_path, "docs"), "s3://bucket-one/docs")
+    state.map_directory(local_dir(tmp_path, "pics"), "s3://bucket-one/pics")
+    for bucket in state.managed_buckets:
+        prefix = bucket.directory_maps[0].s3_prefix
+        bucket.create_fileobject(f"{prefix}/a", 1, MD5, 1)
+    state.serialize()
+    for shard in state.shards.values():
+        shard.unlock()
+    assert len(state.shard_paths()) == 2
+
+    selected = syncfile.sharded_syncfile(state_dir, selection=[("bucket-one", "pics")])
+    selected.deserialize()
+    assert selected.shard_mode == "dirmap"
+    assert [key for _, key in fileobjects(selected)] == ["pics/a"]
+    for shard in selected.shards.values():
+        shard.unlock()